@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# Benchmarks for the Benefits hot paths
+#
+# Inventories are generated from the species in eco/data with a fixed
+# seed, so runs are comparable release over release. Results are written
+# as json, one record per benchmark:
+#
+#     python benchmarks/bench.py --sizes 1000,10000,1000000 -o bench.json
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+import numpy as np  # NOQA
+
+from eco.core import Benefits, data_base  # NOQA
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_REGIONS = ['NoEastXXX', 'CaNCCoJBK', 'PacfNWLOG', 'CenFlaXXX']
+
+
+def best_of(repeat, setup, run):
+    """
+    Returns the fastest of repeat timings of run, calling setup (if
+    given) untimed before each one and passing its result to run
+    """
+    timings = []
+    for _ in xrange(repeat):
+        args = setup() if setup else ()
+        start = default_timer()
+        run(*args)
+        timings.append(default_timer() - start)
+
+    return min(timings)
+
+
+def species_for_region(region):
+    """
+    Returns the species codes with data for every benefit factor in region
+    """
+    tensor = Benefits().get_factor_tensor(region)
+
+    return sorted(code for code, i in tensor.species_index.iteritems()
+                  if not np.isnan(tensor.values[:, i, 0]).any())
+
+
+def make_inventory(regions, size, species_count=None, seed=0):
+    """
+    Returns arrays of regions, species codes and dbhs for a synthetic
+    inventory of size trees. Dbhs are recorded to 0.1 cm like a real
+    inventory
+    """
+    random = np.random.RandomState(seed)
+
+    tree_regions = np.array(regions)[random.randint(len(regions),
+                                                    size=size)]
+    codes = np.empty(size, dtype=object)
+
+    for region in regions:
+        species = species_for_region(region)[:species_count]
+        in_region = tree_regions == region
+        codes[in_region] = np.array(species)[
+            random.randint(len(species), size=in_region.sum())]
+
+    dbhs = np.round(random.uniform(0, 150, size), 1)
+
+    return tree_regions, codes.astype(str), dbhs
+
+
+def bench_get_data(regions, repeat):
+    def load_all(benefits):
+        for region in regions:
+            for factor in Benefits.BENEFIT_FACTORS:
+                benefits._get_data(region, factor)
+
+    warm = Benefits()
+    load_all(warm)
+
+    yield ({'name': '_get_data', 'cache': 'cold', 'regions': len(regions)},
+           best_of(repeat, lambda: (Benefits(),), load_all))
+    yield ({'name': '_get_data', 'cache': 'warm', 'regions': len(regions)},
+           best_of(repeat, None, lambda: load_all(warm)))
+
+
+def bench_lookup_species_code(regions, repeat, lookups=1000):
+    names = [('Acer', 'rubrum'), ('Magnolia', 'x soulangiana'),
+             ('Cedrus', 'atlantica'), ('Ecoputius', None)]
+    names = (names * lookups)[:lookups]
+
+    def lookup(benefits):
+        for region in regions:
+            for name in names:
+                benefits.lookup_species_code(region, *name)
+
+    warm = Benefits()
+    lookup(warm)
+
+    params = {'name': 'lookup_species_code', 'regions': len(regions),
+              'lookups': lookups}
+
+    yield (dict(params, cache='cold'),
+           best_of(repeat, lambda: (Benefits(),), lookup))
+    yield (dict(params, cache='warm'),
+           best_of(repeat, None, lambda: lookup(warm)))
+
+
+def bench_evaluation(regions, sizes, species_counts, repeat):
+    region = regions[0]
+    warm = Benefits()
+
+    for size in sizes:
+        for species_count in species_counts:
+            _, codes, dbhs = make_inventory([region], size, species_count)
+            trees = zip(codes, dbhs)
+
+            params = {'region': region, 'trees': size, 'cache': 'warm',
+                      'species': len(set(codes))}
+
+            warm.get_air_quality_stats(region, trees[:1])
+            warm.get_factor_tensor(region)
+
+            yield (dict(params, name='get_factor_and_conversion_for_trees'),
+                   best_of(repeat, None,
+                           lambda: warm.get_factor_and_conversion_for_trees(
+                               region, 'bvoc', trees)))
+
+            yield (dict(params, name='get_air_quality_stats'),
+                   best_of(repeat, None,
+                           lambda: warm.get_air_quality_stats(region,
+                                                              trees)))
+
+            yield (dict(params, name='get_factors_for_tree_arrays'),
+                   best_of(repeat, None,
+                           lambda: warm.get_factors_for_tree_arrays(
+                               region, None, codes, dbhs)))
+
+        yield ({'name': 'get_air_quality_stats', 'region': region,
+                'trees': size, 'cache': 'cold'},
+               best_of(repeat, lambda: (Benefits(),),
+                       lambda benefits: benefits.get_air_quality_stats(
+                           region, trees)))
+
+
+def bench_regions(regions, sizes, repeat):
+    warm = Benefits()
+
+    for size in sizes:
+        for count in xrange(1, len(regions) + 1):
+            tree_regions, codes, dbhs = make_inventory(regions[:count], size)
+
+            warm.get_factors_by_region(tree_regions, None, codes, dbhs)
+
+            yield ({'name': 'get_factors_by_region', 'trees': size,
+                    'regions': count, 'cache': 'warm'},
+                   best_of(repeat, None,
+                           lambda: warm.get_factors_by_region(
+                               tree_regions, None, codes, dbhs)))
+
+
+def bench_projection(regions, sizes, repeat, years=(10, 40)):
+    region = regions[0]
+    warm = Benefits()
+
+    for size in sizes:
+        _, codes, dbhs = make_inventory([region], size)
+        warm.project_factors(region, None, codes[:1], dbhs[:1], 1)
+
+        for horizon in years:
+            yield ({'name': 'project_factors', 'region': region,
+                    'trees': size, 'years': horizon, 'cache': 'warm'},
+                   best_of(repeat, None,
+                           lambda: warm.project_factors(
+                               region, None, codes, dbhs, horizon)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated inventory sizes, up to '
+                        '10000000')
+    parser.add_argument('--species', default='5,0',
+                        help='comma separated numbers of species per '
+                        'inventory, 0 for every species in the region')
+    parser.add_argument('--regions', default=','.join(DEFAULT_REGIONS),
+                        help='comma separated regions')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per benchmark, the fastest is kept')
+    parser.add_argument('-o', '--output', help='json output file, defaults '
+                        'to stdout')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    species_counts = [int(count) or None
+                      for count in args.species.split(',')]
+    regions = args.regions.split(',')
+
+    benchmarks = [bench_get_data(regions, args.repeat),
+                  bench_lookup_species_code(regions, args.repeat),
+                  bench_evaluation(regions, sizes, species_counts,
+                                   args.repeat),
+                  bench_regions(regions, sizes, args.repeat),
+                  bench_projection(regions, sizes, args.repeat)]
+
+    results = []
+    for benchmark in benchmarks:
+        for params, seconds in benchmark:
+            params['seconds'] = seconds
+            results.append(params)
+            sys.stderr.write('%s\n' % json.dumps(params, sort_keys=True))
+
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'bundle': os.path.exists(os.path.join(data_base,
+                                                    'factors.bundle')),
+              'results': results}
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
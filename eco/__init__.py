@@ -1,3 +1,37 @@
-from core import Benefits
+"""
+Calculate eco benefits for urban trees
 
-benefits = Benefits()
+Importing eco is cheap: eco.core, and with it numpy, is only imported the
+first time Benefits or benefits is used, and no data is read until a
+Benefits instance needs it.
+"""
+import sys
+import types
+
+_LAZY_ATTRIBUTES = ('Benefits', 'benefits')
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError("'module' object has no attribute '%s'"
+                                 % name)
+
+        from eco import core
+
+        for attribute in _LAZY_ATTRIBUTES:
+            setattr(self, attribute, getattr(core, attribute))
+
+        return getattr(core, name)
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY_ATTRIBUTES))
+
+
+# Python 2 modules can't define __getattr__, so the package replaces itself
+# with a module that can. The original is kept referenced, otherwise its
+# globals would be cleared when it is garbage collected
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
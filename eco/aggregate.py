@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class BenefitAggregate(object):
+    def __init__(self, benefits, factors=None):
+        """
+        Running benefit totals for a set of trees that changes over time
+
+        Each tree's factor values are computed once when it is added and
+        kept, so adding, removing or changing the dbh of a tree only
+        touches that tree. Trees are evaluated with
+        Benefits.get_factors_for_tree_arrays, so totals match a full
+        recompute by the same Benefits instance, including its
+        interpolation, to within floating point tolerance.
+
+        benefits - The Benefits instance to evaluate trees with
+        factors - The factors to keep totals for, defaults to all of the
+                  benefit factors
+        """
+        self._benefits = benefits
+        self._factors = tuple(factors or benefits.BENEFIT_FACTORS)
+
+        # tree id -> (region, species code, dbh, factor values,
+        #             converted factor values)
+        self._trees = {}
+
+        # region -> array of factor totals
+        self._totals = {}
+
+        # region -> array of converted factor totals, NaN for factors that
+        # aren't converted
+        self._converted = {}
+
+        # region -> number of trees
+        self._counts = {}
+
+    @property
+    def factors(self):
+        return self._factors
+
+    @property
+    def regions(self):
+        return set(self._counts)
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __contains__(self, tree_id):
+        return tree_id in self._trees
+
+    def _evaluate(self, region, species_code, dbh):
+        """
+        Returns arrays of the factor values and converted factor values of
+        a single tree
+        """
+        per_tree, totals = self._benefits.get_factors_for_tree_arrays(
+            region, self._factors, [species_code], [dbh])
+
+        converted = [totals[factor][1] for factor in self._factors]
+        converted = np.array([np.nan if c is None else c for c in converted])
+
+        return per_tree[:, 0], converted
+
+    def _apply(self, region, values, converted, sign):
+        if region not in self._totals:
+            self._totals[region] = np.zeros(len(self._factors))
+            self._converted[region] = np.zeros(len(self._factors))
+            self._counts[region] = 0
+
+        self._totals[region] += sign * values
+        self._converted[region] += sign * converted
+        self._counts[region] += sign
+
+        # Once a region is empty drop its totals rather than keeping the
+        # rounding left over from the subtractions
+        if self._counts[region] == 0:
+            del self._totals[region]
+            del self._converted[region]
+            del self._counts[region]
+
+    def add(self, tree_id, region, species_code, dbh):
+        if tree_id in self._trees:
+            raise Exception('Tree %s has already been added' % tree_id)
+
+        values, converted = self._evaluate(region, species_code, dbh)
+
+        self._apply(region, values, converted, 1)
+        self._trees[tree_id] = (region, species_code, dbh, values,
+                                converted)
+
+    def remove(self, tree_id):
+        if tree_id not in self._trees:
+            raise Exception('Tree %s has not been added' % tree_id)
+
+        region, _, _, values, converted = self._trees.pop(tree_id)
+
+        self._apply(region, values, converted, -1)
+
+    def update_dbh(self, tree_id, dbh):
+        if tree_id not in self._trees:
+            raise Exception('Tree %s has not been added' % tree_id)
+
+        (region, species_code, _,
+         old_values, old_converted) = self._trees[tree_id]
+        values, converted = self._evaluate(region, species_code, dbh)
+
+        self._totals[region] += values - old_values
+        self._converted[region] += converted - old_converted
+        self._trees[tree_id] = (region, species_code, dbh, values,
+                                converted)
+
+    def totals(self, region):
+        """
+        Returns a dictionary of factor to a (factor, converted factor)
+        tuple of the totals for the trees in a region, in the same form as
+        Benefits.get_factors_and_conversions_for_trees
+        """
+        if region not in self._totals:
+            _, totals = self._benefits.get_factors_for_tree_arrays(
+                region, self._factors, [], [])
+            return totals
+
+        return {factor: (f, None if np.isnan(c) else c)
+                for factor, f, c in zip(self._factors,
+                                        self._totals[region],
+                                        self._converted[region])}
@@ -0,0 +1,80 @@
+"""
+An asyncio facade for Benefits
+
+Requires asyncio, or the trollius backport and futures on python 2, which
+are installed with the async extra (pip install eco.py[async])
+"""
+from functools import partial
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from core import Benefits
+
+
+class AsyncBenefits(object):
+    def __init__(self, benefits=None, executor=None, loop=None):
+        """
+        Wraps a Benefits instance so its methods return futures that can
+        be awaited from an event loop
+
+        Table loading and evaluation both run in executor, so neither
+        blocks the loop. Requests that need the same table while it is
+        still loading wait for the one load in progress (see
+        Benefits._load_once), so concurrent requests for several regions
+        can safely be gathered.
+
+        benefits - The Benefits instance to wrap, defaults to a new one
+        executor - The concurrent.futures executor to run work in,
+                   defaults to the loop's default executor
+        loop - The event loop, defaults to the current event loop
+        """
+        self.benefits = benefits or Benefits()
+        self._executor = executor
+        self._loop = loop
+
+    def _run(self, method, *args, **kwargs):
+        loop = self._loop or asyncio.get_event_loop()
+
+        return loop.run_in_executor(self._executor,
+                                    partial(method, *args, **kwargs))
+
+    def preload(self, regions=None, factors=None):
+        return self._run(self.benefits.preload, regions, factors)
+
+    def get_factors_and_conversions_for_trees(self, region, factors,
+                                              species_codes_and_dbh,
+                                              per_tree=False):
+        return self._run(self.benefits.get_factors_and_conversions_for_trees,
+                         region, factors, species_codes_and_dbh,
+                         per_tree=per_tree)
+
+    def get_factors_for_tree_arrays(self, region, factors, species_codes,
+                                    dbhs=None):
+        return self._run(self.benefits.get_factors_for_tree_arrays,
+                         region, factors, species_codes, dbhs)
+
+    def get_factors_by_region(self, regions, factors, species_codes, dbhs):
+        return self._run(self.benefits.get_factors_by_region,
+                         regions, factors, species_codes, dbhs)
+
+    def get_energy_conserved(self, region, species_codes_and_dbh,
+                             per_tree=False):
+        return self._run(self.benefits.get_energy_conserved,
+                         region, species_codes_and_dbh, per_tree=per_tree)
+
+    def get_stormwater_management(self, region, species_codes_and_dbh,
+                                  per_tree=False):
+        return self._run(self.benefits.get_stormwater_management,
+                         region, species_codes_and_dbh, per_tree=per_tree)
+
+    def get_co2_stats(self, region, species_codes_and_dbh, per_tree=False):
+        return self._run(self.benefits.get_co2_stats,
+                         region, species_codes_and_dbh, per_tree=per_tree)
+
+    def get_air_quality_stats(self, region, species_code_and_dbh,
+                              per_tree=False):
+        return self._run(self.benefits.get_air_quality_stats,
+                         region, species_code_and_dbh, per_tree=per_tree)
@@ -0,0 +1,346 @@
+"""
+Reading and writing factor tables
+
+The factor tables ship as one csv file per region and factor. Parsing all
+of them is slow, so they can also be compiled into a single binary bundle:
+
+    python -m eco.bundle [-d data_dir] [-o bundle_path] [--validate]
+
+A bundle is laid out as:
+
+    magic (8 bytes) | version (uint32) | header length (uint32) |
+    json header | padding to 8 bytes | float64 data
+
+The header maps each table to the offset and length of its dbh breaks and
+species rows inside of the data block, and records the size and
+modification time of each csv file the bundle was built from. A bundle
+whose csv files have changed since is stale and isn't read.
+"""
+import os
+import re
+import json
+import struct
+import itertools
+import argparse
+import numpy as np
+
+BUNDLE_MAGIC = b'ECOBNDL\0'
+BUNDLE_VERSION = 2
+BUNDLE_FILENAME = 'factors.bundle'
+
+DATA_FILE_PATTERN = r'^output__(.*)__(.*)\.csv$'
+
+# Worksheets that hold text rather than values by dbh, left out of
+# validated bundles
+TEXT_TABLES = ('species_codes', 'toc')
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def _safe_float(f):
+    try:
+        return float(f)
+    except ValueError:
+        return 0.0
+
+
+def _strip_trailing_empty_cells(alist):
+    return list(itertools.takewhile(lambda a: a, alist))
+
+
+def read_factor_csv(data_file):
+    """
+    Parses a factor csv file into a tuple of an array of dbh breaks and
+    a dictionary of species code to an array of values
+
+    Cells that aren't numbers are read as 0.0
+    """
+    alldata = [row.split(',')
+               for row in open(data_file).read().split('\n')]
+    dbh_breaks_dirty = alldata[0][1:]
+
+    # It is possible the dbh break set contains empty strings at the
+    # end, so trim ending cells while empty
+    dbh_breaks = np.array(
+        map(_safe_float, _strip_trailing_empty_cells(dbh_breaks_dirty)))
+
+    datarows = alldata[1:]
+
+    data = {}
+
+    for row in datarows:
+        if len(row[0]) > 0:
+            row_data = map(_safe_float,
+                           _strip_trailing_empty_cells(row[1:]))
+            data[row[0]] = np.array(row_data)
+
+    return dbh_breaks, data
+
+
+def _is_number(cell):
+    try:
+        float(cell)
+        return True
+    except ValueError:
+        return False
+
+
+def validate_factor_csv(data_file):
+    """
+    Parses a factor csv file like read_factor_csv, but raises an Exception
+    for anything that read_factor_csv would silently read as 0.0
+
+    Rows keyed by a number rather than a species code are notes left in
+    the worksheet and are dropped. Otherwise the dbh breaks must be
+    numbers in increasing order and every row must have a number for
+    each break.
+    """
+    alldata = [row.split(',')
+               for row in open(data_file).read().split('\n')]
+
+    breaks = _strip_trailing_empty_cells(alldata[0][1:])
+    if not all(_is_number(cell) for cell in breaks):
+        raise Exception('%s: dbh breaks %s are not all numbers'
+                        % (data_file, breaks))
+
+    dbh_breaks = np.array(map(float, breaks))
+    if (np.diff(dbh_breaks) <= 0).any():
+        raise Exception('%s: dbh breaks %s are not increasing'
+                        % (data_file, breaks))
+
+    data = {}
+    for line, row in enumerate(alldata[1:], 2):
+        code = row[0]
+        if len(code) == 0 or _is_number(code):
+            continue
+
+        cells = _strip_trailing_empty_cells(row[1:])
+        if len(cells) != len(dbh_breaks):
+            raise Exception('%s:%s: %s has %s values for %s dbh breaks'
+                            % (data_file, line, code, len(cells),
+                               len(dbh_breaks)))
+        if not all(_is_number(cell) for cell in cells):
+            raise Exception('%s:%s: %s has values that are not numbers'
+                            % (data_file, line, code))
+
+        data[code] = np.array(map(float, cells))
+
+    return dbh_breaks, data
+
+
+def list_data_files(data_dir):
+    """
+    Returns a list of (region, factor, filename) tuples for every factor
+    csv file in data_dir
+    """
+    matches = []
+    for datafile in sorted(os.listdir(data_dir)):
+        match = re.match(DATA_FILE_PATTERN, datafile)
+        if match:
+            matches.append((match.group(1), match.group(2), datafile))
+
+    return matches
+
+
+def _table_key(region, factor):
+    return '%s__%s' % (region, factor)
+
+
+def source_stamps(data_dir, filenames):
+    """
+    Returns a dictionary of each of filenames in data_dir to its size and
+    modification time, which change whenever the file is edited
+    """
+    stamps = {}
+    for filename in filenames:
+        stat = os.stat(os.path.join(data_dir, filename))
+        stamps[filename] = [stat.st_size, stat.st_mtime]
+
+    return stamps
+
+
+def write_bundle(tables, bundle_path, sources=None):
+    """
+    Writes a dictionary of (region, factor) to (breaks, data) tuples, as
+    returned by read_factor_csv, to a bundle at bundle_path
+
+    sources - A dictionary of the csv files the tables were read from to
+              their source_stamps, used to tell when the bundle is stale
+
+    The bundle is written to a temporary file first and moved into place,
+    so readers never see a partially written bundle
+    """
+    chunks = []
+    offset = [0]
+
+    def add(values):
+        values = np.asarray(values, dtype='<f8')
+        chunks.append(values)
+        span = [offset[0], len(values)]
+        offset[0] += len(values)
+        return span
+
+    index = {}
+    for (region, factor) in sorted(tables):
+        breaks, data = tables[(region, factor)]
+        index[_table_key(region, factor)] = {
+            'breaks': add(breaks),
+            'rows': {code: add(data[code]) for code in sorted(data)}
+        }
+
+    header = json.dumps({'version': BUNDLE_VERSION,
+                         'sources': sources or {},
+                         'tables': index}).encode('utf-8')
+    padding = -(_PREAMBLE.size + len(header)) % 8
+
+    tmp_path = '%s.tmp.%s' % (bundle_path, os.getpid())
+    with open(tmp_path, 'wb') as out:
+        out.write(_PREAMBLE.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header)))
+        out.write(header)
+        out.write(b'\0' * padding)
+        if chunks:
+            np.concatenate(chunks).tofile(out)
+
+    os.rename(tmp_path, bundle_path)
+
+
+def build_bundle(data_dir, bundle_path, validate=False):
+    """
+    Compiles every factor csv file in data_dir into a bundle at bundle_path
+
+    If validate is True the tables are read with validate_factor_csv, so
+    the first malformed table raises an Exception and nothing is written,
+    and TEXT_TABLES are left out
+    """
+    data_files = [(region, factor, f)
+                  for region, factor, f in list_data_files(data_dir)
+                  if not (validate and factor in TEXT_TABLES)]
+
+    # Stamp the files before reading them, so an edit made while the
+    # bundle is being built makes it stale rather than being missed
+    sources = source_stamps(data_dir, [f for _, _, f in data_files])
+
+    read = validate_factor_csv if validate else read_factor_csv
+    tables = {(region, factor): read(os.path.join(data_dir, f))
+              for region, factor, f in data_files}
+
+    write_bundle(tables, bundle_path, sources)
+
+
+class FactorBundle(object):
+    def __init__(self, header, values):
+        """
+        Factor tables read from a bundle
+
+        Tables are sliced out of the values array on request, so nothing
+        is copied until a table is used
+        """
+        self._tables = header['tables']
+        self._values = values
+
+    def __contains__(self, region_factor):
+        return _table_key(*region_factor) in self._tables
+
+    def get(self, region, factor):
+        """
+        Returns the (breaks, data) tuple for a table, in the same form as
+        read_factor_csv
+        """
+        table = self._tables[_table_key(region, factor)]
+
+        def view(span):
+            start, length = span
+            return self._values[start:start + length]
+
+        data = {str(code): view(span)
+                for code, span in table['rows'].iteritems()}
+
+        return view(table['breaks']), data
+
+
+def _is_stale(header, data_dir):
+    """
+    Returns True if any of the csv files a bundle was built from has been
+    changed or removed since
+    """
+    for filename, stamp in header['sources'].iteritems():
+        try:
+            current = source_stamps(data_dir, [filename])[filename]
+        except OSError:
+            return True
+
+        if current != stamp:
+            return True
+
+    return False
+
+
+def read_bundle(bundle_path, mmap=False, data_dir=None):
+    """
+    Reads the bundle at bundle_path, returning None if there is no bundle,
+    it was written by an incompatible version of this library or it is
+    stale, so that the csv files are read instead
+
+    data_dir - The directory of the csv files the bundle was built from,
+               defaults to the bundle's directory. The bundle is stale if
+               any of them has changed since it was built
+
+    If mmap is True the data block is memory-mapped read-only instead of
+    being read into memory, so every process reading the same bundle
+    shares a single copy of the tables through the page cache
+    """
+    if not os.path.exists(bundle_path):
+        return None
+
+    with open(bundle_path, 'rb') as bundle:
+        preamble = bundle.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            return None
+
+        magic, version, header_length = _PREAMBLE.unpack(preamble)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            return None
+
+        header = json.loads(bundle.read(header_length).decode('utf-8'))
+
+        if _is_stale(header, data_dir or os.path.dirname(bundle_path)):
+            return None
+
+        # Skip the padding that aligns the data block
+        bundle.read(-(_PREAMBLE.size + header_length) % 8)
+        data_offset = bundle.tell()
+
+        if not mmap:
+            values = np.fromfile(bundle, dtype='<f8')
+
+    if mmap:
+        if os.path.getsize(bundle_path) > data_offset:
+            values = np.memmap(bundle_path, dtype='<f8', mode='r',
+                               offset=data_offset)
+        else:
+            values = np.zeros(0)
+
+    return FactorBundle(header, values)
+
+
+def main():
+    from eco.core import data_base
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data-dir', default=data_base,
+                        help='directory of factor csv files')
+    parser.add_argument('-o', '--output',
+                        help='bundle path, defaults to %s in the data '
+                        'directory' % BUNDLE_FILENAME)
+    parser.add_argument('--validate', action='store_true',
+                        help='fail on malformed tables instead of reading '
+                        'junk cells as 0.0')
+    args = parser.parse_args()
+
+    build_bundle(args.data_dir,
+                 args.output or os.path.join(args.data_dir, BUNDLE_FILENAME),
+                 validate=args.validate)
+
+
+if __name__ == '__main__':
+    main()
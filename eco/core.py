@@ -1,22 +1,40 @@
 import os
-import re
+import bisect
+import hashlib
 import itertools
+import multiprocessing
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from functools import partial
+from timeit import default_timer
 import numpy as np
 
-import sys
+from bundle import (BUNDLE_FILENAME, TEXT_TABLES, list_data_files,
+                    read_bundle, read_factor_csv)
 
-data_base = os.path.join(
-    os.path.dirname(sys.modules['eco'].__file__),
-    'data')
+# The data shipped with this package, which Benefits reads by default
+data_base = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Tables that don't hold species values by dbh, so are left out of region
+# tensors
+NON_DBH_TABLES = TEXT_TABLES + ('dbh_by_age_class', 'interpolation_range')
+
+
+def is_empty(elem):
+    """
+    Returns True for None and falsy scalars. Arrays of per tree values are
+    never empty, even if they are all zero
+    """
+    return elem is None or (np.isscalar(elem) and not elem)
 
 
 def sum_ignore_none(elems):
     """
-    Sums an iterable, filtering out falsy values and returning None if all
-    values are falsy
+    Sums an iterable, filtering out empty values and returning None if all
+    values are empty
     """
-    elems = filter(None, elems)
+    elems = [elem for elem in elems if not is_empty(elem)]
     return sum(elems) if elems else None
 
 
@@ -28,101 +46,702 @@ def sum_factor_and_conversion(*args):
     return map(sum_ignore_none, zip(*args))
 
 
+def interp_rows(breaks, values, dbh):
+    """
+    Interpolates every row of values (shape (..., len(breaks))) at each dbh
+
+    Behaves like np.interp applied to each row, including clamping to the
+    first and last values outside of the breaks, but shares the search for
+    the surrounding breaks across all of the rows
+    """
+    clamped, lo, hi = _interp_positions(breaks, dbh)
+
+    slope = ((values[..., hi] - values[..., lo]) /
+             (breaks[hi] - breaks[lo]))
+
+    return slope * (clamped - breaks[lo]) + values[..., lo]
+
+
+def _interp_positions(breaks, dbh):
+    """
+    Returns the dbhs clamped to the breaks along with the indices of the
+    breaks on either side of each of them
+    """
+    dbh = np.asarray(dbh, dtype=float)
+    clamped = np.clip(dbh, breaks[0], breaks[-1])
+
+    hi = np.clip(np.searchsorted(breaks, clamped, side='right'),
+                 1, len(breaks) - 1)
+
+    return clamped, hi - 1, hi
+
+
+def interp_tensor(tensor, species, dbh):
+    """
+    Interpolates every factor in a FactorTensor for each tree, given an
+    array of species indices into the tensor and an array of dbhs
+
+    species may also be a (factor x tree) array, when a tree's species
+    index differs between factors
+
+    Returns a (factor x tree) array
+    """
+    breaks = tensor.breaks
+    clamped, lo, hi = _interp_positions(breaks, dbh)
+
+    offset = clamped - breaks[lo]
+    width = breaks[hi] - breaks[lo]
+
+    species = np.asarray(species, dtype=int)
+    per_factor = species.ndim == 2
+
+    result = np.empty((len(tensor.factors), len(clamped)))
+    for i, values in enumerate(tensor.values):
+        factor_species = species[i] if per_factor else species
+        lo_values = values[factor_species, lo]
+        result[i] = ((values[factor_species, hi] - lo_values) / width *
+                     offset + lo_values)
+
+    return result
+
+
+def chunk_trees(trees, size):
+    """
+    Splits an iterable of trees into lists of at most size trees, without
+    reading more than one chunk of the iterable at a time
+    """
+    trees = iter(trees)
+    while True:
+        chunk = list(itertools.islice(trees, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+class BenefitStats(object):
+    PHASES = ('load', 'group', 'interpolate', 'convert')
+
+    def __init__(self, callback=None):
+        """
+        Counters and timings collected by a Benefits instance
+
+        Counters:
+            table_loads - factor tables read from csv or the bundle
+            table_cache_hits, table_cache_misses - lookups of factor
+                tables, see table_loads
+            tensor_cache_hits, tensor_cache_misses - lookups of region
+                tensors
+            grid_cache_hits, grid_cache_misses - lookups of region grids
+            result_cache_hits, result_cache_misses - see result_cache_size
+            trees - trees evaluated
+
+        Timings, in seconds, are kept for each of PHASES:
+            load - reading factor tables
+            group - grouping trees by species
+            interpolate - interpolating factor values
+            convert - building the totals and converted totals
+
+        callback - An optional function called as callback('count', name,
+                   increment) and callback('time', phase, seconds)
+        """
+        self._callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timings = dict.fromkeys(BenefitStats.PHASES, 0.0)
+
+    def count(self, name, increment=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+        if self._callback:
+            self._callback('count', name, increment)
+
+    @contextmanager
+    def timer(self, phase):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            seconds = default_timer() - start
+
+            with self._lock:
+                self._timings[phase] += seconds
+
+            if self._callback:
+                self._callback('time', phase, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timings': dict(self._timings)}
+
+    def merge(self, stats):
+        """
+        Adds the counters and timings of another BenefitStats, given as
+        returned by its as_dict
+        """
+        for name, increment in stats.get('counters', {}).iteritems():
+            self.count(name, increment)
+
+        for phase, seconds in stats.get('timings', {}).iteritems():
+            with self._lock:
+                self._timings[phase] += seconds
+
+            if self._callback:
+                self._callback('time', phase, seconds)
+
+
+class _NoStats(object):
+    """
+    Stands in for BenefitStats when stats are disabled, doing nothing
+    """
+    def count(self, name, increment=1):
+        pass
+
+    def timer(self, phase):
+        return _NO_TIMER
+
+    def reset(self):
+        pass
+
+    def as_dict(self):
+        return {}
+
+    def merge(self, stats):
+        pass
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STATS = _NoStats()
+_NO_TIMER = _NoTimer()
+
+
+# A set of factor tables for a region, sampled on a regular grid of dbhs so
+# that values can be looked up by index instead of interpolated
+#
+# factors, factor_index and species_index are the same as in FactorTensor
+# resolution    - spacing of the grid in cm, starting from 0
+# values        - (factor x species x grid point) float32 array
+FactorGrid = namedtuple('FactorGrid', ['factors', 'factor_index',
+                                       'species_index', 'resolution',
+                                       'values'])
+
+
+def interp_grid(grid, species, dbh, rows=None):
+    """
+    Looks up every factor in a FactorGrid for each tree, given an array of
+    species indices into the grid and an array of dbhs
+
+    Each dbh is rounded to the nearest grid point, so results are exact
+    (to float32 precision) for dbhs recorded to the grid's resolution. As
+    with interp_tensor, species may also be a (factor x tree) array.
+
+    rows - Indices of the factors to look up, defaults to every factor in
+           the grid
+
+    Returns a (factor x tree) array of float64, so that sums over many
+    trees don't lose precision
+    """
+    last = grid.values.shape[-1] - 1
+    points = np.rint(np.asarray(dbh, dtype=float) / grid.resolution)
+    points = np.clip(points, 0, last).astype(int)
+
+    species = np.asarray(species, dtype=int)
+    if rows is None:
+        if species.ndim == 1:
+            return grid.values[:, species, points].astype(float)
+
+        rows = np.arange(len(grid.factors))
+
+    rows = np.asarray(rows, dtype=int)[:, np.newaxis]
+
+    return grid.values[rows, species, points].astype(float)
+
+
+# Factor totals for trees in several regions
+#
+# regions - tuple of region names, in the order of the first axis
+# factors - tuple of factor names, in the order of the second axis
+# values  - (region x factor) array of totals
+FactorTotals = namedtuple('FactorTotals', ['regions', 'factors', 'values'])
+
+
+# Conversion rates, such as dollars per unit, for several pricing
+# scenarios at once
+#
+# scenarios - tuple of scenario names, in the order of the first axis
+# regions   - tuple of region names, in the order of the second axis
+# factors   - tuple of factor names, in the order of the third axis
+# rates     - (scenario x region x factor) array, 0 for factors that are
+#             not converted
+ConversionTable = namedtuple('ConversionTable', ['scenarios', 'regions',
+                                                 'factors', 'rates'])
+
+
+def make_conversion_table(scenarios, regions, factors):
+    """
+    Builds a ConversionTable for regions and factors
+
+    scenarios - A list of (name, conversions) tuples, or a dictionary of
+                name to conversions, where conversions is a dictionary of
+                region to a dictionary of factor to rate. Rates under the
+                region None apply to every region without a rate of its
+                own for that factor, so a flat factor_conversions
+                dictionary can be used as {None: factor_conversions}
+    """
+    if isinstance(scenarios, dict):
+        scenarios = sorted(scenarios.iteritems())
+
+    regions = tuple(regions)
+    factors = tuple(factors)
+
+    rates = np.zeros((len(scenarios), len(regions), len(factors)))
+
+    for s, (_, conversions) in enumerate(scenarios):
+        for r, region in enumerate((None,) + regions):
+            region_rates = conversions.get(region, {})
+            # Region specific rates overwrite the defaults for every region
+            row = rates[s] if region is None else rates[s, r - 1]
+
+            for f, factor in enumerate(factors):
+                if factor in region_rates:
+                    row[..., f] = region_rates[factor]
+
+    return ConversionTable(tuple(name for name, _ in scenarios), regions,
+                           factors, rates)
+
+
+def apply_conversion_table(table, totals):
+    """
+    Converts FactorTotals under every scenario of a ConversionTable at once
+
+    Regions and factors are matched by name, those missing from table are
+    not converted. Returns a (scenario x region) array of converted totals,
+    in the order of table.scenarios and totals.regions
+    """
+    region_index = {region: i for i, region in enumerate(table.regions)}
+    factor_index = {factor: i for i, factor in enumerate(table.factors)}
+
+    # Pad the rates with a zero region and factor for anything unmatched
+    rates = np.zeros((len(table.scenarios), len(table.regions) + 1,
+                      len(table.factors) + 1))
+    rates[:, :-1, :-1] = table.rates
+
+    regions = [region_index.get(region, -1) for region in totals.regions]
+    factors = [factor_index.get(factor, -1) for factor in totals.factors]
+    rates = rates[:, regions][:, :, factors]
+
+    # One (region x factor) . (factor) product per region, for every
+    # scenario
+    return np.einsum('srf,rf->sr', rates,
+                     np.asarray(totals.values, dtype=float))
+
+
+# The Benefits instance used by each process of a parallel evaluation, see
+# Benefits.get_factors_in_parallel. It is set while the pool is started so
+# that forked workers inherit the caller's instance, with the lock held so
+# concurrent calls don't hand their workers each other's instance
+_worker_benefits = None
+_worker_lock = threading.Lock()
+
+
+def _init_worker(kwargs):
+    global _worker_benefits
+
+    # Without fork, such as on Windows, nothing is inherited
+    if _worker_benefits is None:
+        _worker_benefits = Benefits(**kwargs)
+
+    # Counters and timings are sent back with each shard and merged into
+    # the caller's stats, which also calls its stats_callback
+    if isinstance(_worker_benefits._stats, BenefitStats):
+        _worker_benefits._stats = BenefitStats()
+
+
+def _evaluate_shard(args):
+    region, factors, species_codes, dbhs = args
+
+    stats = _worker_benefits._stats
+    stats.reset()
+
+    _, totals = _worker_benefits.get_factors_for_tree_arrays(
+        region, factors, species_codes, dbhs)
+
+    return ({factor: f for factor, (f, _) in totals.iteritems()},
+            stats.as_dict())
+
+
+# A compiled set of factor tables for a region
+#
+# factors       - tuple of factor names, in the order of the first axis
+# factor_index  - dictionary of factor name to index in factors
+# species_index - dictionary of species code to index in the second axis
+# breaks        - array of dbh breaks shared by every factor
+# values        - (factor x species x dbh break) array, species without data
+#                 for a factor are NaN
+FactorTensor = namedtuple('FactorTensor', ['factors', 'factor_index',
+                                           'species_index', 'breaks',
+                                           'values'])
+
+
 class Benefits(object):
     WATTS_PER_BTU = 0.29307107
     GAL_PER_CUBIC_M = 264.172052
     LBS_PER_KG = 2.20462
 
-    def __init__(self, factor_conversions=None):
+    CO2_FACTORS = ('co2_sequestered', 'co2_avoided', 'co2_storage')
+    AIR_QUALITY_FACTORS = ('aq_ozone_dep',
+                           'aq_nox_dep', 'aq_nox_avoided',
+                           'aq_pm10_dep', 'aq_pm10_avoided',
+                           'aq_sox_dep', 'aq_sox_avoided',
+                           'aq_voc_avoided', 'bvoc')
+    BENEFIT_FACTORS = (CO2_FACTORS + AIR_QUALITY_FACTORS +
+                       ('natural_gas', 'electricity', 'hydro_interception'))
+
+    INTERPOLATIONS = ('exact', 'grid')
+
+    # The most dbhs project_factors interpolates per call, across all of
+    # the years evaluated together
+    PROJECTION_BLOCK_SIZE = 1000000
+
+    def __init__(self, factor_conversions=None, compiled=False,
+                 bundle_path=None, mmap=False, interpolation='exact',
+                 grid_resolution=0.1, result_cache_size=0, stats=False,
+                 stats_callback=None, data_dir=None):
         """
         Class for getting i-Tree eco-benfits for trees
 
+        Nothing is read from the data directory until it is needed
+
         factor_conversions - An optional dictionary of factor to multiplier
                              Intended for converting benefits into money saved
+
+        compiled - If True, factors are evaluated against a per-region
+                   FactorTensor (see get_factor_tensor) so every factor
+                   for a species is interpolated in one operation
+
+        bundle_path - Path of the compiled factor bundle to read tables
+                      from (see eco.bundle). Defaults to the bundle in the
+                      data directory, if one has been built
+
+        mmap - If True the bundle is memory-mapped read-only, so processes
+               on the same host share one copy of the factor tables
+               instead of each holding their own. Tensors and grids are
+               still built by each process
+
+        interpolation - How the array based methods, such as
+                        get_factors_for_tree_arrays, interpolate. 'exact'
+                        interpolates between the dbh breaks, 'grid' looks
+                        values up in a FactorGrid (see get_factor_grid)
+                        with dbhs rounded to grid_resolution cm. The
+                        summary methods, such as get_co2_stats, always
+                        interpolate exactly, per_tree included. At the
+                        default resolution a region's grid of benefit
+                        factors takes 2 to 3 MB, about 40 MB for every
+                        region, and grows as the resolution shrinks
+
+        grid_resolution - Spacing in cm of the grid used by 'grid'
+                          interpolation
+
+        result_cache_size - The number of results of
+                            get_factors_and_conversions_for_trees (and so
+                            of the summary methods) to keep, keyed by the
+                            region, factors and trees, evicting the least
+                            recently used. 0 disables the cache
+
+        stats - If True, counters and per phase timings are collected in
+                a BenefitStats (see get_stats)
+
+        stats_callback - A function called with each counter increment
+                         and timing as it happens, see BenefitStats.
+                         Implies stats
+
+        data_dir - Directory of factor tables and species lists to read,
+                   defaults to the data shipped with this package
         """
-        self._species_list_cache = None
+        if interpolation not in Benefits.INTERPOLATIONS:
+            raise Exception('Invalid interpolation %s, should be one of %s'
+                            % (interpolation, Benefits.INTERPOLATIONS))
+
+        # Tables that are loaded once on first use, by name
+        self._loaded = {}
         self._factor_cache = {}
-        self._regions = None
+        self._tensor_cache = {}
+        self._grid_cache = {}
+        self._assignment_cache = {}
+        self._resolution_cache = {}
+        self._growth_cache = {}
+        self._result_cache = OrderedDict()
+        self._result_cache_size = result_cache_size
+        self._result_cache_hits = 0
+        self._result_cache_misses = 0
+        self._compiled = compiled
+        self._interpolation = interpolation
+        self._grid_resolution = grid_resolution
+        self._bundle_path = bundle_path
+        self._mmap = mmap
+        self._data_dir = data_dir or data_base
+
+        # Everything needed to build an equivalent instance in another
+        # process
+        self._init_kwargs = {'factor_conversions': factor_conversions,
+                             'compiled': compiled,
+                             'bundle_path': bundle_path,
+                             'mmap': mmap,
+                             'interpolation': interpolation,
+                             'grid_resolution': grid_resolution,
+                             'result_cache_size': result_cache_size,
+                             'stats': stats or bool(stats_callback),
+                             'data_dir': data_dir}
         self._factor_conversions = factor_conversions or {}
 
+        if stats or stats_callback:
+            self._stats = BenefitStats(stats_callback)
+        else:
+            self._stats = _NO_STATS
+
+        # _lock guards _load_locks and the result cache, _load_locks holds
+        # a lock per table so each table is only loaded by one thread
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _load_once(self, cache, key, load, stat=None):
+        """
+        Returns cache[key], calling load to fill it in if it is missing
+
+        Safe to call from many threads. Only one thread loads a given key,
+        while the others wait for it instead of loading it themselves
+
+        stat - If given, hits and misses are counted as <stat>_hits and
+               <stat>_misses
+        """
+        try:
+            value = cache[key]
+            if stat:
+                self._stats.count(stat + '_hits')
+            return value
+        except KeyError:
+            if stat:
+                self._stats.count(stat + '_misses')
+
+        with self._lock:
+            key_lock = self._load_locks.setdefault((id(cache), key),
+                                                   threading.Lock())
+
+        with key_lock:
+            if key not in cache:
+                cache[key] = load()
+
+        return cache[key]
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the collected counters and timings, see
+        BenefitStats.as_dict. Empty unless the instance collects stats
+        """
+        return self._stats.as_dict()
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def preload(self, regions=None, factors=None):
+        """
+        Loads tables ahead of time so that the first requests don't pay
+        for parsing them
+
+        regions - The regions to load, defaults to every region
+        factors - The factors to load in each region, defaults to every
+                  factor the region has. When left out, the region's
+                  tensor (used by the array methods, and by every method
+                  when compiled) is built as well, and so is its grid when
+                  the instance uses grid interpolation
+        """
+        self._get_species_code_index()
+
+        for region in regions or self.regions:
+            region_factors = factors or self.factors_for_region(region)
+
+            for factor in region_factors:
+                self._get_data(region, factor)
+
+            if factors is None:
+                self._get_region_tensor(region)
+
+                if self._interpolation == 'grid':
+                    self._get_region_grid(region, self._grid_resolution)
+
     # ALL DBH UNITS ARE CM
-    def _data_files(self):
-        pattern = r'output__(.*)__(.*).csv'
-        matches = []
-        for datafile in os.listdir(data_base):
-            match = re.match(pattern, datafile)
-            if match:
-                matches.append(match)
+    def _get_manifest(self):
+        """
+        Returns a dictionary of region to the set of factors with data for
+        that region, built from a single listing of the data directory
+        """
+        def load():
+            manifest = {}
+            for region, factor, _ in list_data_files(self._data_dir):
+                manifest.setdefault(region, set()).add(factor)
+
+            return {region: frozenset(factors)
+                    for region, factors in manifest.iteritems()}
 
-        return matches
+        return self._load_once(self._loaded, 'manifest', load)
 
     @property
     def regions(self):
-        if self._regions is None:
-            self._regions = {m.group(1) for m in self._data_files()}
-
-        return self._regions
+        return set(self._get_manifest())
 
     def factors_for_region(self, region):
-        return {m.group(2) for m in self._data_files()}
+        self._assert_valid_region(region)
+
+        return set(self._get_manifest()[region])
 
     def _assert_valid_region(self, region):
-        if region not in self.regions:
+        if region not in self._get_manifest():
             raise Exception('Invalid region %s' % region)
 
-    def _strip_trailing_empty_cells(self, alist):
-        return list(itertools.takewhile(lambda a: a, alist))
+    def _get_bundle(self):
+        """
+        Returns the compiled factor bundle, or None if there isn't a
+        usable one, in which case csv files are read
+        """
+        def load():
+            bundle_path = (self._bundle_path or
+                           os.path.join(self._data_dir, BUNDLE_FILENAME))
+
+            return read_bundle(bundle_path, mmap=self._mmap,
+                               data_dir=self._data_dir)
+
+        return self._load_once(self._loaded, 'bundle', load)
 
     def _get_data(self, region, factor):
-        self._assert_valid_region(region)
+        manifest = self._get_manifest()
+
+        if region not in manifest:
+            raise Exception('Invalid region %s' % region)
+
+        if factor not in manifest[region]:
+            raise Exception('Invalid facor, %s, for region %s'
+                            % (factor, region))
 
-        data_file = os.path.join(data_base,
+        data_file = os.path.join(self._data_dir,
                                  'output__%s__%s.csv' % (region, factor))
 
-        if data_file not in self._factor_cache:
+        def load():
+            self._stats.count('table_loads')
+            with self._stats.timer('load'):
+                # The first table loaded also pays for reading the bundle
+                bundle = self._get_bundle()
 
-            if factor not in self.factors_for_region(region):
-                raise Exception('Invalid facor, %s, for region %s'
-                                % (factor, region))
+                if bundle is not None and (region, factor) in bundle:
+                    return bundle.get(region, factor)
+                else:
+                    return read_factor_csv(data_file)
 
-            alldata = [row.split(',')
-                       for row in open(data_file).read().split('\n')]
-            dbh_breaks_dirty = alldata[0][1:]
+        return self._load_once(self._factor_cache, data_file, load,
+                               'table_cache')
 
-            def safe_float(f):
-                try:
-                    return float(f)
-                except:
-                    return 0.0
+    def _get_region_tensor(self, region):
+        """
+        Compiles every table of values by dbh in a region into a single
+        FactorTensor, built once per region
 
-            # It is possible the dbh break set contains empty strings at the
-            # end, so trim ending cells while empty
-            dbh_breaks = np.array(
-                map(safe_float,
-                    self._strip_trailing_empty_cells(dbh_breaks_dirty)))
+        Factors with differing dbh breaks are resampled onto the union of
+        the breaks, which is exact for piecewise linear data
+        """
+        def load():
+            factors = tuple(sorted(self.factors_for_region(region) -
+                                   set(NON_DBH_TABLES)))
+            tables = [self._get_data(region, factor) for factor in factors]
 
-            datarows = alldata[1:]
+            breaks = np.unique(np.concatenate([b for b, _ in tables]))
 
-            data = {}
+            # Rows that don't line up with the breaks are spreadsheet
+            # leftovers that can't be interpolated, so they are dropped
+            valid_rows = [{code: row for code, row in data.iteritems()
+                           if len(row) == len(factor_breaks)}
+                          for factor_breaks, data in tables]
 
-            for row in datarows:
-                if len(row[0]) > 0:
-                    row_data = map(safe_float,
-                                   self._strip_trailing_empty_cells(row[1:]))
-                    data[row[0]] = np.array(row_data)
+            codes = sorted(set(itertools.chain.from_iterable(valid_rows)))
+            species_index = {code: i for i, code in enumerate(codes)}
 
-            self._factor_cache[data_file] = (dbh_breaks, data)
+            values = np.empty((len(factors), len(codes), len(breaks)))
+            values.fill(np.nan)
 
-        return self._factor_cache[data_file]
+            for i, ((factor_breaks, _), rows) in enumerate(zip(tables,
+                                                               valid_rows)):
+                for code, row in rows.iteritems():
+                    values[i, species_index[code]] = np.interp(
+                        breaks, factor_breaks, row)
 
-    def lookup_species_code(self, region, genus, species=None, cultivar=None):
+            return FactorTensor(
+                factors, {f: i for i, f in enumerate(factors)},
+                species_index, breaks, values)
 
-        self._assert_valid_region(region)
+        return self._load_once(self._tensor_cache, region, load,
+                               'tensor_cache')
 
-        if self._species_list_cache is None:
-            data_file = os.path.join(data_base, 'species_master_list.csv')
-            self._species_list_cache = open(data_file).read().split('\n')
+    def _factor_rows(self, region, factor_index, factors):
+        """
+        Returns the indices of factors in a region tensor's factor_index
+        """
+        rows = []
+        for factor in factors:
+            if factor not in factor_index:
+                raise Exception('Invalid facor, %s, for region %s'
+                                % (factor, region))
+            rows.append(factor_index[factor])
 
+        return np.array(rows, dtype=int)
+
+    def get_factor_tensor(self, region, factors=None):
+        """
+        Returns a FactorTensor of the given factors (all of the benefit
+        factors by default) in a region, selected from the region's tensor
+        of every factor
+        """
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+        tensor = self._get_region_tensor(region)
+        rows = self._factor_rows(region, tensor.factor_index, factors)
+
+        return FactorTensor(
+            factors, {f: i for i, f in enumerate(factors)},
+            tensor.species_index, tensor.breaks, tensor.values[rows])
+
+    def _get_species_code_index(self):
+        """
+        Returns a dictionary of (region, lowercase scientific name) to
+        species code, built from the species master list on first use
+        """
+        def load():
+            data_file = os.path.join(self._data_dir,
+                                     'species_master_list.csv')
+
+            index = {}
+            for datarow in open(data_file).read().split('\n'):
+                cols = [c.strip() for c in datarow.split(',')]
+
+                # When a name is listed more than once for a region the
+                # first listing wins
+                if len(cols) >= 5:
+                    index.setdefault((cols[-1], cols[1].lower()), cols[4])
+
+            return index
+
+        return self._load_once(self._loaded, 'species_code_index', load)
+
+    def _scientific_name(self, genus, species=None, cultivar=None):
         sci_name = genus
 
         if species:
@@ -130,16 +749,188 @@ class Benefits(object):
             if cultivar:
                 sci_name = "%s '%s'" % (sci_name, cultivar)
 
-        sci_name = sci_name.lower()
+        return sci_name.lower()
+
+    def _get_region_grid(self, region, resolution, factors=None):
+        """
+        Samples the region's tensor at every multiple of resolution cm from
+        0 up to the last dbh break, as a float32 FactorGrid built once per
+        region and resolution
+
+        Only the benefit factors are sampled, since the other tables (lsa,
+        electricity-sfr and so on) are rarely looked up and would make up
+        most of the grid. factors that include any of those get a grid of
+        just the given factors, cached separately
+        """
+        tensor = self._get_region_tensor(region)
+        self._factor_rows(region, tensor.factor_index, factors or ())
+
+        if factors is None or set(factors) <= set(Benefits.BENEFIT_FACTORS):
+            key = (region, resolution)
+            grid_factors = tuple(f for f in tensor.factors
+                                 if f in Benefits.BENEFIT_FACTORS)
+        else:
+            key = (region, resolution, tuple(factors))
+            grid_factors = tuple(factors)
+
+        def load():
+            rows = [tensor.factor_index[f] for f in grid_factors]
+
+            points = int(np.ceil(tensor.breaks[-1] / resolution)) + 1
+            dbhs = np.arange(points) * resolution
+            values = interp_rows(tensor.breaks, tensor.values[rows], dbhs)
+
+            return FactorGrid(
+                grid_factors, {f: i for i, f in enumerate(grid_factors)},
+                tensor.species_index, resolution, values.astype(np.float32))
+
+        return self._load_once(self._grid_cache, key, load, 'grid_cache')
+
+    def get_factor_grid(self, region, factors=None, resolution=None):
+        """
+        Returns a FactorGrid of the given factors (all of the benefit
+        factors by default) in a region, sampled every resolution cm (the
+        instance's grid_resolution by default), selected from the region's
+        grid of every factor
+        """
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+        grid = self._get_region_grid(region,
+                                     resolution or self._grid_resolution,
+                                     factors)
+        rows = self._factor_rows(region, grid.factor_index, factors)
+
+        return FactorGrid(
+            factors, {f: i for i, f in enumerate(factors)},
+            grid.species_index, grid.resolution, grid.values[rows])
+
+    def check_grid_accuracy(self, region, factors=None, dbhs=None,
+                            resolution=None):
+        """
+        Compares 'grid' interpolation against 'exact' interpolation for
+        every species in a region
+
+        dbhs - The dbhs to compare at. Defaults to ten samples per grid
+               step, running past the last dbh break
+
+        Returns a dictionary of factor to the largest absolute difference
+        """
+        tensor = self.get_factor_tensor(region, factors)
+        grid = self.get_factor_grid(region, factors, resolution)
+
+        if dbhs is None:
+            dbhs = np.arange(0, tensor.breaks[-1] * 1.1,
+                             grid.resolution / 10.0)
+
+        dbhs = np.asarray(dbhs, dtype=float)
+        species = np.repeat(np.arange(len(tensor.species_index)), len(dbhs))
+        dbhs = np.tile(dbhs, len(tensor.species_index))
+
+        errors = np.abs(interp_grid(grid, species, dbhs) -
+                        interp_tensor(tensor, species, dbhs))
+
+        # Species without data for a factor are NaN in both
+        return {factor: np.nanmax(factor_errors) if len(factor_errors) else 0.0
+                for factor, factor_errors in zip(tensor.factors, errors)}
+
+    def _get_species_assignments(self, region):
+        """
+        Returns a dictionary of species code to the code whose values are
+        used for it (the SppValueAssignment column), from the species
+        master list and the region's species_codes table
+        """
+        def load():
+            assignments = {}
+
+            def add_rows(data_file, row_region=None):
+                for datarow in open(data_file).read().split('\n'):
+                    cols = [c.strip() for c in datarow.split(',')]
+
+                    if (len(cols) >= 5 and cols[0] and cols[4] and
+                       (row_region is None or cols[-1] == row_region)):
+                        assignments.setdefault(cols[0], cols[4])
+
+            if 'species_codes' in self._get_manifest()[region]:
+                add_rows(os.path.join(
+                    self._data_dir, 'output__%s__species_codes.csv' % region))
+
+            add_rows(os.path.join(self._data_dir, 'species_master_list.csv'),
+                     region)
+
+            return assignments
+
+        return self._load_once(self._assignment_cache, region, load)
+
+    def get_species_resolution(self, region, factors=None):
+        """
+        Precomputes, for every species code known in a region, the code
+        whose data is used for each factor (all of the benefit factors by
+        default)
+
+        A code with data for a factor resolves to itself. Otherwise its
+        species value assignments are followed (for instance from ACPL to
+        'BDL OTHER') until a code with data is found. Codes that can't be
+        resolved are left out.
+
+        Returns a dictionary of factor to a dictionary of species code to
+        resolved species code
+        """
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+
+        def load():
+            tensor = self._get_region_tensor(region)
+            assignments = self._get_species_assignments(region)
+
+            codes = set(assignments) | set(tensor.species_index)
 
-        for datarow in self._species_list_cache:
-            cols = [c.strip() for c in datarow.split(',')]
+            resolution = {}
+            for i, factor in enumerate(tensor.factors):
+                def has_data(code):
+                    index = tensor.species_index.get(code)
+                    return (index is not None and
+                            not np.isnan(tensor.values[i, index, 0]))
 
-            if (len(cols) >= 3 and
-               cols[1].lower() == sci_name and cols[-1] == region):
-                return cols[4]
+                resolved = {}
+                for code in codes:
+                    seen = set()
+                    candidate = code
+                    while candidate is not None and candidate not in seen:
+                        if has_data(candidate):
+                            resolved[code] = candidate
+                            break
 
-        return None
+                        seen.add(candidate)
+                        candidate = assignments.get(candidate)
+
+                resolution[factor] = resolved
+
+            return resolution
+
+        resolution = self._load_once(self._resolution_cache, region, load)
+        tensor = self._get_region_tensor(region)
+        self._factor_rows(region, tensor.factor_index, factors)
+
+        return {factor: resolution[factor] for factor in factors}
+
+    def lookup_species_code(self, region, genus, species=None, cultivar=None):
+        return self.lookup_species_codes(
+            region, [(genus, species, cultivar)])[0]
+
+    def lookup_species_codes(self, region, names):
+        """
+        Looks up the species codes for many trees in a region at once
+
+        names - An iterable of (genus, species, cultivar) tuples, where
+                species and cultivar may be None or left off
+
+        Returns a list of species codes in the same order as names, with
+        None for names that aren't in the region
+        """
+        self._assert_valid_region(region)
+
+        index = self._get_species_code_index()
+
+        return [index.get((region, self._scientific_name(*name)))
+                for name in names]
 
     def linear_interp(self, x1, y1, x2, y2, x):
         m = (y2 - y1) / (x2 - x1)
@@ -166,11 +957,13 @@ class Benefits(object):
             return values[-1]
 
         # Determine the interval that we're in
-        for i in xrange(1, len(breaks)):
-            if dbh >= breaks[i-1] and \
-               dbh < breaks[i]:
-                return self.linear_interp(breaks[i-1], values[i-1],
-                                          breaks[i], values[i], dbh)
+        i = bisect.bisect_right(breaks, dbh)
+
+        if i == len(breaks):
+            return values[-1]
+
+        return self.linear_interp(breaks[i-1], values[i-1],
+                                  breaks[i], values[i], dbh)
 
     def get_factor_for_trees(self, *args, **kwargs):
         # Since there is legacy code that expects this to return a single value
@@ -178,11 +971,11 @@ class Benefits(object):
         factor, _ = self.get_factor_and_conversion_for_trees(*args, **kwargs)
         return factor
 
-    def get_factor_and_conversion_for_trees(self, region, factor,
-                                            species_codes_and_dbh):
-        breaks, data = self._get_data(region, factor)
-
-        # Group by species, only use first code
+    def _group_by_species(self, species_codes_and_dbh):
+        """
+        Groups an iterable of (species code, dbh) tuples into a dictionary
+        of species code to an array of dbhs
+        """
         species = {}
 
         for (scs, dbh) in species_codes_and_dbh:
@@ -191,6 +984,27 @@ class Benefits(object):
 
             species[scs].append(dbh)
 
+        return {code: np.array(dbhs, dtype=float)
+                for code, dbhs in species.iteritems()}
+
+    def _convert_factor(self, factor, f):
+        if factor in self._factor_conversions:
+            return f * self._factor_conversions[factor]
+        else:
+            return None
+
+    def _convert_totals(self, factors, totals):
+        """
+        Returns a dictionary of factor to a (factor, converted factor)
+        tuple, given the totals for each of factors
+        """
+        with self._stats.timer('convert'):
+            return {factor: (f, self._convert_factor(factor, f))
+                    for factor, f in zip(factors, totals)}
+
+    def _evaluate_factor(self, region, factor, table, species):
+        breaks, data = table
+
         f = 0
         for code in species:
             if code in data:
@@ -200,49 +1014,638 @@ class Benefits(object):
                                 'factor %s in region %s for species %s' %
                                 (factor, region, code))
 
-        if factor in self._factor_conversions:
-            converted_factor = f * self._factor_conversions[factor]
+        return f
+
+    def _tensor_species(self, region, tensor, codes):
+        """
+        Returns an array of the indices of each of codes in tensor, raising
+        if any of them are missing data for one of the tensor's factors
+        """
+        indices = np.array([tensor.species_index.get(code, -1)
+                            for code in codes], dtype=int)
+
+        for code, index in zip(codes, indices):
+            if index < 0:
+                missing = np.ones(len(tensor.factors), dtype=bool)
+            else:
+                missing = np.isnan(tensor.values[:, index, 0])
+
+            if missing.any():
+                raise Exception('Could not find data for '
+                                'factor %s in region %s for species %s' %
+                                (tensor.factors[missing.argmax()],
+                                 region, code))
+
+        return indices
+
+    def _evaluate_factors_compiled(self, tensor, region, species):
+        codes = list(species)
+        indices = self._tensor_species(region, tensor, codes)
+
+        totals = np.zeros(len(tensor.factors))
+        for code, index in zip(codes, indices):
+            totals += np.sum(interp_rows(tensor.breaks,
+                                         tensor.values[:, index],
+                                         species[code]), axis=1)
+
+        return totals
+
+    def get_factor_and_conversion_for_trees(self, region, factor,
+                                            species_codes_and_dbh,
+                                            per_tree=False):
+        results = self.get_factors_and_conversions_for_trees(
+            region, [factor], species_codes_and_dbh, per_tree=per_tree)
+
+        return results[factor]
+
+    def get_factors_and_conversions_for_trees(self, region, factors,
+                                              species_codes_and_dbh,
+                                              per_tree=False):
+        """
+        Evaluates several factors for the same trees in a single pass
+
+        The trees are only grouped by species once, no matter how many
+        factors are requested. Returns a dictionary of factor to a
+        (factor, converted factor) tuple
+
+        If per_tree is True the factor and converted factor are arrays
+        with a value for each tree, in the same order as the trees
+        """
+        if per_tree:
+            return self._evaluate_factors_per_tree(region, factors,
+                                                   species_codes_and_dbh)
+
+        if self._result_cache_size:
+            trees = list(species_codes_and_dbh)
+            key = (region, tuple(factors), self._fingerprint_trees(trees))
+
+            return self._get_cached_result(
+                key, partial(self._evaluate_factors, region, factors, trees))
+
+        return self._evaluate_factors(region, factors, species_codes_and_dbh)
+
+    def _evaluate_factors(self, region, factors, species_codes_and_dbh):
+        # Group by species, only use first code
+        with self._stats.timer('group'):
+            species = self._group_by_species(species_codes_and_dbh)
+
+        self._stats.count('trees', sum(len(dbhs)
+                                       for dbhs in species.itervalues()))
+
+        if self._compiled:
+            tensor = self.get_factor_tensor(region, factors)
+
+            with self._stats.timer('interpolate'):
+                totals = self._evaluate_factors_compiled(tensor, region,
+                                                         species)
+        else:
+            tables = [self._get_data(region, factor) for factor in factors]
+
+            with self._stats.timer('interpolate'):
+                totals = [self._evaluate_factor(region, factor, table,
+                                                species)
+                          for factor, table in zip(factors, tables)]
+
+        return self._convert_totals(factors, totals)
+
+    def _fingerprint_trees(self, trees):
+        """
+        Returns a digest of a list of (species code, dbh) tuples, which is
+        the same for two lists exactly when they hold the same trees in the
+        same order
+        """
+        digest = hashlib.sha1()
+        digest.update('\0'.join(str(code) for code, _ in trees))
+        digest.update(np.array([dbh for _, dbh in trees],
+                               dtype=float).tostring())
+
+        return digest.hexdigest()
+
+    def _get_cached_result(self, key, evaluate):
+        """
+        Returns the cached result for key, calling evaluate and caching its
+        result on a miss. The least recently used result is evicted once
+        the cache is full
+        """
+        cache = self._result_cache
+
+        with self._lock:
+            result = cache.pop(key, None)
+
+            if result is None:
+                self._result_cache_misses += 1
+                self._stats.count('result_cache_misses')
+            else:
+                self._result_cache_hits += 1
+                self._stats.count('result_cache_hits')
+                cache[key] = result
+
+        if result is None:
+            # Evaluate without holding the lock, so other requests aren't
+            # held up behind a slow one
+            result = evaluate()
+
+            with self._lock:
+                cache.pop(key, None)
+                while len(cache) >= self._result_cache_size:
+                    cache.popitem(last=False)
+
+                cache[key] = result
+
+        return dict(result)
+
+    def result_cache_info(self):
+        """
+        Returns a dictionary of statistics about the result cache
+        """
+        with self._lock:
+            return {'hits': self._result_cache_hits,
+                    'misses': self._result_cache_misses,
+                    'size': len(self._result_cache),
+                    'maxsize': self._result_cache_size}
+
+    def clear_result_cache(self):
+        with self._lock:
+            self._result_cache.clear()
+            self._result_cache_hits = 0
+            self._result_cache_misses = 0
+
+    def _evaluate_factors_per_tree(self, region, factors,
+                                   species_codes_and_dbh):
+        trees = list(species_codes_and_dbh)
+        species_codes = [code for code, _ in trees]
+        dbhs = [dbh for _, dbh in trees]
+
+        # The totals of the summary methods are always interpolated exactly,
+        # so the values for each tree are as well, whatever the instance's
+        # interpolation, and add up to those totals
+        per_tree, _ = self._evaluate_tree_arrays(
+            region, factors, species_codes, dbhs, 'exact')
+
+        return {factor: (values, self._convert_factor(factor, values))
+                for factor, values in zip(factors, per_tree)}
+
+    def get_factors_for_tree_arrays(self, region, factors, species_codes,
+                                    dbhs=None):
+        """
+        Evaluates several factors for trees given as parallel arrays
+
+        species_codes - An array of species codes, one per tree
+        dbhs - An array of dbhs in cm, one per tree
+
+        Alternatively species_codes may be a structured array with
+        'species_code' and 'dbh' fields, in which case dbhs is omitted.
+
+        Returns a tuple of a (factor x tree) array of the value of each
+        factor for each tree, in the order of factors, and a dictionary of
+        factor to a (factor, converted factor) tuple of the totals
+        """
+        if dbhs is None:
+            species_codes, dbhs = (species_codes['species_code'],
+                                   species_codes['dbh'])
+
+        return self._evaluate_tree_arrays(region, factors, species_codes,
+                                          dbhs, self._interpolation)
+
+    def _evaluate_tree_arrays(self, region, factors, species_codes, dbhs,
+                              interpolation):
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if species_codes.shape != dbhs.shape:
+            raise Exception('species codes and dbhs should be the same '
+                            'length\n%s and %s' % (len(species_codes),
+                                                   len(dbhs)))
+
+        tensor = self.get_factor_tensor(region, factors)
+
+        with self._stats.timer('group'):
+            codes, inverse = np.unique(species_codes, return_inverse=True)
+            species = self._tensor_species(region, tensor, codes)[inverse]
+
+        self._stats.count('trees', len(dbhs))
+
+        per_tree = self._interp_trees(region, tensor, species, dbhs,
+                                      interpolation)
+        totals = per_tree.sum(axis=1)
+
+        return per_tree, self._convert_totals(tensor.factors, totals)
+
+    def _interp_trees(self, region, tensor, species, dbhs,
+                      interpolation=None):
+        if (interpolation or self._interpolation) == 'grid':
+            # Look the factors up in the region's grid rather than copying
+            # them out of it with get_factor_grid
+            grid = self._get_region_grid(region, self._grid_resolution,
+                                         tensor.factors)
+            rows = self._factor_rows(region, grid.factor_index,
+                                     tensor.factors)
+
+            with self._stats.timer('interpolate'):
+                return interp_grid(grid, species, dbhs, rows)
         else:
-            converted_factor = None
+            with self._stats.timer('interpolate'):
+                return interp_tensor(tensor, species, dbhs)
+
+    def get_factors_with_fallbacks(self, region, factors, species_codes,
+                                   dbhs=None):
+        """
+        Evaluates several factors for trees given as arrays, as in
+        get_factors_for_tree_arrays, but resolves species without data to
+        the species they are assigned to (see get_species_resolution)
+
+        Rather than raising for trees that can't be resolved, their values
+        are NaN and they are left out of the totals.
 
-        return f, converted_factor
+        Returns a tuple of the (factor x tree) array, the dictionary of
+        factor to (factor, converted factor) totals and an array of the
+        indices of the trees that couldn't be resolved for some factor
+        """
+        if dbhs is None:
+            species_codes, dbhs = (species_codes['species_code'],
+                                   species_codes['dbh'])
+
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if species_codes.shape != dbhs.shape:
+            raise Exception('species codes and dbhs should be the same '
+                            'length\n%s and %s' % (len(species_codes),
+                                                   len(dbhs)))
+
+        tensor = self.get_factor_tensor(region, factors)
+        resolution = self.get_species_resolution(region, tensor.factors)
+
+        with self._stats.timer('group'):
+            codes, inverse = np.unique(species_codes, return_inverse=True)
+
+            # (factor x unique code) array of tensor indices, -1 if
+            # unresolved
+            indices = np.array(
+                [[tensor.species_index.get(resolution[factor].get(code), -1)
+                  for code in codes.tolist()]
+                 for factor in tensor.factors], dtype=int)
+            indices = indices.reshape(len(tensor.factors), len(codes))
+
+            species = indices[:, inverse]
+            missing = species < 0
+
+        self._stats.count('trees', len(dbhs))
+
+        per_tree = self._interp_trees(region, tensor,
+                                      np.where(missing, 0, species), dbhs)
+        per_tree[missing] = np.nan
+
+        totals = np.nansum(per_tree, axis=1)
+
+        return (per_tree,
+                self._convert_totals(tensor.factors, totals),
+                np.flatnonzero(missing.any(axis=0)))
+
+    def iter_factors_for_chunks(self, region, factors, chunks):
+        """
+        Evaluates several factors for a stream of tree chunks, such as
+        fetchmany results from a database cursor
+
+        chunks - An iterable of chunks, each an iterable of
+                 (species code, dbh) tuples. chunk_trees can split a flat
+                 iterable of trees into chunks
+
+        Yields a dictionary of factor to a (factor, converted factor) tuple
+        for each chunk. Only one chunk is held in memory at a time, and
+        chunks bypass the result cache so they don't evict other results
+        """
+        for chunk in chunks:
+            yield self._evaluate_factors(region, factors, chunk)
+
+    def get_factors_for_chunks(self, region, factors, chunks):
+        """
+        Totals several factors over a stream of tree chunks, as described
+        in iter_factors_for_chunks, with memory bounded by the chunk size
+
+        Returns a dictionary of factor to a (factor, converted factor) tuple
+        """
+        totals = dict.fromkeys(factors, 0)
+
+        for results in self.iter_factors_for_chunks(region, factors, chunks):
+            for factor, (f, _) in results.iteritems():
+                totals[factor] += f
+
+        return self._convert_totals(totals.keys(), totals.values())
+
+    def get_factor_totals(self, regions, factors, species_codes, dbhs):
+        """
+        Evaluates several factors for trees from many regions at once, as
+        in get_factors_by_region, returning the unconverted totals as
+        FactorTotals
+
+        The totals can be converted under many scenarios without
+        evaluating the trees again, see apply_conversion_table
+        """
+        regions = np.asarray(regions)
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if not (regions.shape == species_codes.shape == dbhs.shape):
+            raise Exception('regions, species codes and dbhs should be the '
+                            'same length\n%s, %s and %s' %
+                            (len(regions), len(species_codes), len(dbhs)))
+
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+
+        # Sort the trees by region so each region is a contiguous slice
+        region_names, inverse = np.unique(regions, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.cumsum(np.bincount(inverse,
+                                       minlength=len(region_names)))
+
+        values = np.zeros((len(region_names), len(factors)))
+        start = 0
+        for i, (region, end) in enumerate(zip(region_names.tolist(),
+                                              bounds)):
+            trees = order[start:end]
+            start = end
+
+            per_tree, _ = self.get_factors_for_tree_arrays(
+                region, factors, species_codes[trees], dbhs[trees])
+
+            values[i] = per_tree.sum(axis=1)
+
+        return FactorTotals(tuple(region_names.tolist()), factors, values)
+
+    def get_factors_by_region(self, regions, factors, species_codes, dbhs):
+        """
+        Evaluates several factors for trees from many regions at once
+
+        regions - An array of the region of each tree
+        species_codes - An array of species codes, one per tree
+        dbhs - An array of dbhs in cm, one per tree
+
+        Each region's tables are loaded once and all of its trees are
+        evaluated together. Returns a tuple of a dictionary of region to
+        a dictionary of factor to a (factor, converted factor) tuple, and
+        a dictionary of factor to a (factor, converted factor) tuple of the
+        totals across every region
+        """
+        totals = self.get_factor_totals(regions, factors, species_codes,
+                                        dbhs)
+
+        by_region = {region: self._convert_totals(totals.factors, values)
+                     for region, values in zip(totals.regions, totals.values)}
+
+        return by_region, self._convert_totals(totals.factors,
+                                               totals.values.sum(axis=0))
+
+    def get_growth_curves(self, region):
+        """
+        Returns a tuple of an array of ages in years and a dictionary of
+        species code to an array of the dbh in cm at each age, from the
+        region's dbh_by_age_class table
+
+        Each curve starts from a dbh of 0 at age 0 and never decreases, as
+        a few species' dbhs drop slightly between age classes in the tables
+        """
+        def load():
+            ages, data = self._get_data(region, 'dbh_by_age_class')
+            ages = np.concatenate(([0.0], ages))
+
+            curves = {code: np.maximum.accumulate(
+                np.concatenate(([0.0], dbhs)))
+                for code, dbhs in data.iteritems()
+                if len(dbhs) == len(ages) - 1}
+
+            return ages, curves
+
+        return self._load_once(self._growth_cache, region, load)
+
+    def project_dbhs(self, region, species_codes, dbhs, years):
+        """
+        Grows trees along their species' curves in get_growth_curves
 
-    def get_energy_conserved(self, region, species_codes_and_dbh):
+        Each tree's age is read off its species' curve at its current dbh,
+        advanced by each of years and turned back into a dbh. Trees past
+        the end of their curve keep their current dbh.
+
+        years - A number of years, to project 1 to years years ahead, or
+                an array of the years ahead to project to
+
+        Returns a (year x tree) array of dbhs
+        """
+        ages, curves = self.get_growth_curves(region)
+
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if np.isscalar(years):
+            years = np.arange(1, years + 1)
+        years = np.asarray(years, dtype=float)
+
+        codes, inverse = np.unique(species_codes, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(codes)))
+
+        projected = np.empty((len(years), len(dbhs)))
+        start = 0
+        for code, end in zip(codes.tolist(), bounds):
+            trees = order[start:end]
+            start = end
+
+            if code not in curves:
+                raise Exception('Could not find growth data in region %s '
+                                'for species %s' % (region, code))
+
+            curve = curves[code]
+
+            # Invert the curve over the ages where it is still growing, so
+            # a dbh on a plateau maps to the first age it is reached
+            growing = np.concatenate(([True], np.diff(curve) > 0))
+            tree_ages = np.interp(dbhs[trees], curve[growing],
+                                  ages[growing])
+
+            grown = np.interp(tree_ages + years[:, np.newaxis], ages, curve)
+            projected[:, trees] = np.maximum(grown, dbhs[trees])
+
+        return projected
+
+    def project_factors(self, region, factors, species_codes, dbhs, years):
+        """
+        Projects several factors for trees in a region over a number of
+        years, growing the trees as in project_dbhs
+
+        Every year is evaluated in one pass over the trees (or a few, for
+        very large inventories, see PROJECTION_BLOCK_SIZE), rather than one
+        call per year.
+
+        Returns a tuple of dictionaries of factor to a (factor, converted
+        factor) tuple, the first of each year's totals and the second of
+        the cumulative totals up to each year, as arrays in the order of
+        years
+        """
+        tensor = self.get_factor_tensor(region, factors)
+
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if np.isscalar(years):
+            years = np.arange(1, years + 1)
+        years = np.asarray(years, dtype=float)
+
+        with self._stats.timer('group'):
+            codes, inverse = np.unique(species_codes, return_inverse=True)
+            species = self._tensor_species(region, tensor, codes)[inverse]
+
+        self._stats.count('trees', len(dbhs) * len(years))
+
+        per_year = np.zeros((len(tensor.factors), len(years)))
+        step = max(1, Benefits.PROJECTION_BLOCK_SIZE // max(len(dbhs), 1))
+
+        for start in xrange(0, len(years), step):
+            block = years[start:start + step]
+            projected = self.project_dbhs(region, species_codes, dbhs, block)
+
+            values = self._interp_trees(region, tensor,
+                                        np.tile(species, len(block)),
+                                        projected.ravel())
+            per_year[:, start:start + len(block)] = values.reshape(
+                len(tensor.factors), len(block), len(dbhs)).sum(axis=2)
+
+        return (self._convert_totals(tensor.factors, per_year),
+                self._convert_totals(tensor.factors,
+                                     np.cumsum(per_year, axis=1)))
+
+    def get_factors_in_parallel(self, region, factors, species_codes, dbhs,
+                                workers=None):
+        """
+        Totals several factors for a very large inventory, given as
+        parallel arrays as in get_factors_for_tree_arrays, across a pool of
+        processes
+
+        The trees are split into one shard per worker. Each worker returns
+        partial sums, which are added together here, along with its
+        counters and timings when stats are enabled.
+
+        Where processes are forked, the workers inherit this instance and
+        every table, tensor and grid it has already loaded, so calling
+        preload first saves each worker from loading them. Elsewhere each
+        worker builds and loads its own instance.
+
+        workers - The number of processes to use, defaults to the number
+                  of cpus
+
+        Returns a dictionary of factor to a (factor, converted factor) tuple
+        """
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+        workers = workers or multiprocessing.cpu_count()
+
+        species_codes = np.asarray(species_codes)
+        dbhs = np.asarray(dbhs, dtype=float)
+
+        if species_codes.shape != dbhs.shape:
+            raise Exception('species codes and dbhs should be the same '
+                            'length\n%s and %s' % (len(species_codes),
+                                                   len(dbhs)))
+
+        if workers == 1:
+            _, totals = self.get_factors_for_tree_arrays(
+                region, factors, species_codes, dbhs)
+            return totals
+
+        shards = [(region, factors, species_codes[shard], dbhs[shard])
+                  for shard in np.array_split(np.arange(len(dbhs)), workers)]
+
+        global _worker_benefits
+        with _worker_lock:
+            _worker_benefits = self
+            try:
+                pool = multiprocessing.Pool(workers, _init_worker,
+                                            (self._init_kwargs,))
+            finally:
+                _worker_benefits = None
+
+        try:
+            results = pool.map(_evaluate_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+        for _, stats in results:
+            self._stats.merge(stats)
+
+        totals = {factor: sum(sums[factor] for sums, _ in results)
+                  for factor in factors}
+
+        return self._convert_totals(totals.keys(), totals.values())
+
+    def get_factors_by_group(self, region, factors, species_codes, dbhs,
+                             group_keys):
+        """
+        Totals several factors per group of trees, such as a neighborhood
+        or a species, in a single vectorized pass
+
+        species_codes - An array of species codes, one per tree
+        dbhs - An array of dbhs in cm, one per tree
+        group_keys - An array of the group each tree belongs to
+
+        Returns a dictionary of group key to a dictionary of factor to a
+        (factor, converted factor) tuple
+        """
+        group_keys = np.asarray(group_keys)
+
+        if group_keys.shape != np.shape(dbhs):
+            raise Exception('group keys and dbhs should be the same '
+                            'length\n%s and %s' % (len(group_keys),
+                                                   len(dbhs)))
+
+        factors = tuple(factors or Benefits.BENEFIT_FACTORS)
+        per_tree, _ = self.get_factors_for_tree_arrays(
+            region, factors, species_codes, dbhs)
+
+        groups, inverse = np.unique(group_keys, return_inverse=True)
+
+        totals = np.array([np.bincount(inverse, weights=values,
+                                       minlength=len(groups))
+                           for values in per_tree])
+
+        return {group: self._convert_totals(factors, totals[:, i])
+                for i, group in enumerate(groups.tolist())}
+
+    def get_energy_conserved(self, region, species_codes_and_dbh,
+                             per_tree=False):
         """ Get kWHs of energy conserved """
+        results = self.get_factors_and_conversions_for_trees(
+            region, ['natural_gas', 'electricity'], species_codes_and_dbh,
+            per_tree=per_tree)
+
         # 1000s of BTU?
-        nat_gas_kbtu, nat_gas_converted =\
-            self.get_factor_and_conversion_for_trees(
-                region, 'natural_gas', species_codes_and_dbh)
+        nat_gas_kbtu, nat_gas_converted = results['natural_gas']
 
         nat_gas_kwh = nat_gas_kbtu * Benefits.WATTS_PER_BTU
 
-        energy_kwh, energy_converted =\
-            self.get_factor_and_conversion_for_trees(
-                region, 'electricity', species_codes_and_dbh)
+        energy_kwh, energy_converted = results['electricity']
 
         return (nat_gas_kwh + energy_kwh,
                 sum_ignore_none([nat_gas_converted, energy_converted]))
 
-    def get_stormwater_management(self, region, species_codes_and_dbh):
+    def get_stormwater_management(self, region, species_codes_and_dbh,
+                                  per_tree=False):
         """ Gallons of stormwater reduced """
         stormwater_cubic_m, stormwater_cubic_m_converted =\
             self.get_factor_and_conversion_for_trees(
-                region, 'hydro_interception', species_codes_and_dbh)
+                region, 'hydro_interception', species_codes_and_dbh,
+                per_tree=per_tree)
 
         return (stormwater_cubic_m * Benefits.GAL_PER_CUBIC_M,
                 stormwater_cubic_m_converted * Benefits.GAL_PER_CUBIC_M
-                if stormwater_cubic_m_converted else None)
+                if not is_empty(stormwater_cubic_m_converted) else None)
 
-    def _get_lbs(self, region, species_codes_and_dbh, factor):
-        factor_value_kg, converted_factor_value_kg =\
-            self.get_factor_and_conversion_for_trees(
-                region, factor, species_codes_and_dbh)
+    def _get_lbs(self, results, factor):
+        factor_value_kg, converted_factor_value_kg = results[factor]
 
         return (factor_value_kg * Benefits.LBS_PER_KG,
                 converted_factor_value_kg * Benefits.LBS_PER_KG
-                if converted_factor_value_kg else None)
+                if not is_empty(converted_factor_value_kg) else None)
 
-    def get_co2_stats(self, region, species_codes_and_dbh):
+    def get_co2_stats(self, region, species_codes_and_dbh, per_tree=False):
         """ lbs per year of co2
         provides:
            sequestered
@@ -252,7 +1655,11 @@ class Benefits(object):
         and calculates:
            reduced
         """
-        get_lbs = partial(self._get_lbs, region, species_codes_and_dbh)
+        results = self.get_factors_and_conversions_for_trees(
+            region, Benefits.CO2_FACTORS, species_codes_and_dbh,
+            per_tree=per_tree)
+
+        get_lbs = partial(self._get_lbs, results)
         data = {
             'sequestered': get_lbs('co2_sequestered'),
             'avoided': get_lbs('co2_avoided'),
@@ -264,7 +1671,8 @@ class Benefits(object):
 
         return data
 
-    def get_air_quality_stats(self, region, species_code_and_dbh):
+    def get_air_quality_stats(self, region, species_code_and_dbh,
+                              per_tree=False):
         """ lbs per year of various air quality indicators
         All 'annual' indicators (except for ozone, bvoc, and voc) include
         both 'dep' and 'avoidance' factors
@@ -272,7 +1680,11 @@ class Benefits(object):
         The 'improvement' factor is a synthesis of all of the other
         factors
         """
-        get_lbs = partial(self._get_lbs, region, species_code_and_dbh)
+        results = self.get_factors_and_conversions_for_trees(
+            region, Benefits.AIR_QUALITY_FACTORS, species_code_and_dbh,
+            per_tree=per_tree)
+
+        get_lbs = partial(self._get_lbs, results)
         data = {
             'ozone': get_lbs('aq_ozone_dep'),
             'nox': sum_factor_and_conversion(get_lbs('aq_nox_dep'),
@@ -7,11 +7,19 @@
 import argparse
 import os
 import csv
+import json
+import hashlib
 import subprocess
-from bs4 import BeautifulSoup
+import multiprocessing
+from contextlib import contextmanager
+
+from eco.bundle import BUNDLE_FILENAME, build_bundle, read_bundle
 
 XLS2CSV_EXEC = 'xls2csv'
 
+MANIFEST_FILENAME = 'extract_manifest.json'
+SPECIES_FILENAME = 'species_master_list.csv'
+
 def _assert_has_xls_converter():
     try:
         subprocess.check_call(['which',XLS2CSV_EXEC])
@@ -59,34 +67,188 @@ def extract_data_csvs(output_dir, xls_path):
         print sheetdata[-2]
         exit(3)
 
+@contextmanager
+def atomic_write(path):
+    """
+    Opens a temporary file next to path for writing and moves it into
+    place once the block finishes, so a failed or interrupted extraction
+    never leaves a partially written file behind
+    """
+    # The leading '.' and trailing '.tmp' keep a file left behind by a
+    # killed extraction from ever matching DATA_FILE_PATTERN
+    directory, filename = os.path.split(path)
+    tmp_path = os.path.join(directory,
+                            '.%s.%s.tmp' % (filename, os.getpid()))
+    try:
+        with open(tmp_path, 'w') as out:
+            yield out
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def hash_file(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_manifest(output_dir):
+    """
+    The manifest records, for each action and region, the hash of the
+    source file it was extracted from and the files it produced
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    return json.load(open(manifest_path))
+
+def save_manifest(output_dir, manifest):
+    with atomic_write(os.path.join(output_dir, MANIFEST_FILENAME)) as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+def find_regions(resource_dir, source_filename):
+    """
+    Returns a list of (region, source path) tuples for every region
+    directory in resource_dir containing source_filename
+    """
+    regions = []
+    for root, dirs, files in os.walk(resource_dir):
+        if source_filename in files:
+            regions.append((os.path.split(root)[1],
+                            os.path.join(root, source_filename)))
+
+    return sorted(regions)
+
+def is_unchanged(entry, source_hash, output_dir):
+    return (entry is not None and
+            entry['hash'] == source_hash and
+            all(os.path.exists(os.path.join(output_dir, output))
+                for output in entry['outputs']))
+
+def run_regions(work, tasks, jobs):
+    """
+    Calls work on each of tasks, on a pool of jobs processes when jobs is
+    more than 1, returning the results in order
+    """
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            return pool.map(work, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return map(work, tasks)
+
 def parse_path(soup, path):
+    """
+    Writes each table in soup to a csv file named after path and the
+    table's category, returning the filenames written
+    """
     ids = {}
     for tag in soup.find('p').find_all('a'):
         ids[tag['href'][1:]] = tag.get_text().lower().replace(' ','_')
 
-    last_ref = None
+    written = []
     for table in soup.find_all('table'):
         ref_link = table.find_previous_sibling('a')
         category = ids[ref_link['name']]
         file_to_write = "%s__%s.csv" % (path, category)
 
-        writer = file(file_to_write,'w')
+        with atomic_write(file_to_write) as writer:
+            for row in table.find_all('tr'):
+                cells = [cell.get_text().replace(',','') for cell in row.find_all('td')]
+                writer.write(','.join(cells) + "\n")
 
-        for row in table.find_all('tr'):
-            cells = [cell.get_text().replace(',','') for cell in row.find_all('td')]
-            writer.write(','.join(cells) + "\n")
+        written.append(os.path.basename(file_to_write))
 
-def extract_data(output_dir, resource_dir):
-    for root, dirs, files in os.walk(resource_dir):
-        if 'ResourceUnit.html' in files:
-            html_path = os.path.join(root, 'ResourceUnit.html')
-            soup = BeautifulSoup(file(html_path).read())
-            parse_path(soup,
-                       os.path.join(output_dir,
-                                    'output__%s' % os.path.split(root)[1]))
+    return written
+
+def extract_region_data(args):
+    output_dir, region, html_path = args
+
+    # Imported here so the rest of the extractor works without bs4
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(file(html_path).read())
+    return parse_path(soup,
+                      os.path.join(output_dir, 'output__%s' % region))
+
+def extract_data(output_dir, resource_dir, jobs=1, incremental=False,
+                 bundle=False):
+    manifest = load_manifest(output_dir)
+    entries = manifest.setdefault('extract_values', {})
+
+    todo = []
+    for region, html_path in find_regions(resource_dir, 'ResourceUnit.html'):
+        source_hash = hash_file(html_path)
+
+        if incremental and is_unchanged(entries.get(region), source_hash,
+                                        output_dir):
+            print 'Skipping %s, unchanged' % region
+        else:
+            todo.append((region, html_path, source_hash))
+
+    outputs = run_regions(extract_region_data,
+                          [(output_dir, region, html_path)
+                           for region, html_path, _ in todo],
+                          jobs)
+
+    for (region, _, source_hash), written in zip(todo, outputs):
+        entries[region] = {'hash': source_hash, 'outputs': sorted(written)}
+
+    # Validating every table before writing the bundle catches malformed
+    # worksheets here rather than when the tables are used
+    bundle_path = os.path.join(output_dir, BUNDLE_FILENAME)
+    if bundle:
+        if todo or read_bundle(bundle_path) is None:
+            build_bundle(output_dir or '.', bundle_path, validate=True)
+    elif todo and os.path.exists(bundle_path):
+        # A bundle left over from an earlier run would no longer match
+        # the tables just written
+        print 'Removing %s, rebuild it with --bundle' % bundle_path
+        os.remove(bundle_path)
 
+    save_manifest(output_dir, manifest)
 
-def extract_species(output_dir, resource_dir):
+def extract_region_species(args):
+    region_code, species_path = args
+
+    devnull = open('/dev/null','w')
+    p = subprocess.Popen([XLS2CSV_EXEC, species_path],
+                         stdout=subprocess.PIPE,
+                         stderr=devnull)
+    csvdata, err = p.communicate()
+
+    reader = csv.DictReader(csvdata.split('\n'))
+
+    rows = []
+    for row_dict in reader:
+        code = row_dict['SpeciesCode']
+        name = row_dict['ScientificName']
+
+        if is_valid_code(code) and is_valid_name(name):
+            row_dict['region'] = region_code
+            rows.append(row_dict)
+
+    return rows
+
+def read_species_rows(file_path):
+    """
+    Returns a dictionary of region to the rows of an existing species
+    master list, so unchanged regions can be copied over
+    """
+    rows = {}
+    if os.path.exists(file_path):
+        for row_dict in csv.DictReader(open(file_path)):
+            rows.setdefault(row_dict['region'], []).append(row_dict)
+
+    return rows
+
+def extract_species(output_dir, resource_dir, jobs=1, incremental=False):
     _assert_has_xls_converter()
 
     header = ['SpeciesCode','ScientificName','CommonName','Tree Type',
@@ -94,33 +256,44 @@ def extract_species(output_dir, resource_dir):
               'Basic Price ($/sq in)','Palm Trunk Cost($/ft)',
               'Replacement Cost ($)','TAr (sq Inches)','region']
 
-    file_path = os.path.join(output_dir, 'species_master_list.csv')
-    output_file = file(file_path, 'w')
+    file_path = os.path.join(output_dir, SPECIES_FILENAME)
 
-    writer = csv.DictWriter(output_file, header)
-    writer.writeheader()
+    manifest = load_manifest(output_dir)
+    entries = manifest.setdefault('extract_species', {})
+    previous = read_species_rows(file_path) if incremental else {}
 
-    devnull = open('/dev/null','w')
+    regions = find_regions(resource_dir, 'SpeciesCode.xls')
+    rows = {}
+    todo = []
+    for region_code, species_path in regions:
+        source_hash = hash_file(species_path)
 
-    for root, dirs, files in os.walk(resource_dir):
-        if 'SpeciesCode.xls' in files:
-            region_code = os.path.split(root)[1]
+        if (region_code in previous and
+                is_unchanged(entries.get(region_code), source_hash,
+                             output_dir)):
+            print 'Skipping %s, unchanged' % region_code
+            rows[region_code] = previous[region_code]
+        else:
+            todo.append((region_code, species_path, source_hash))
+
+    outputs = run_regions(extract_region_species,
+                          [(region_code, species_path)
+                           for region_code, species_path, _ in todo],
+                          jobs)
 
-            species_path = os.path.join(root, 'SpeciesCode.xls')
-            p = subprocess.Popen([XLS2CSV_EXEC, species_path],
-                                 stdout=subprocess.PIPE,
-                                 stderr=devnull)
-            csvdata, err = p.communicate()
+    for (region_code, _, source_hash), region_rows in zip(todo, outputs):
+        rows[region_code] = region_rows
+        entries[region_code] = {'hash': source_hash,
+                                'outputs': [SPECIES_FILENAME]}
 
-            reader = csv.DictReader(csvdata.split('\n'))
+    with atomic_write(file_path) as output_file:
+        writer = csv.DictWriter(output_file, header)
+        writer.writeheader()
 
-            for row_dict in reader:
-                code = row_dict['SpeciesCode']
-                name = row_dict['ScientificName']
+        for region_code, _ in regions:
+            writer.writerows(rows[region_code])
 
-                if is_valid_code(code) and is_valid_name(name):
-                    row_dict['region'] = region_code
-                    writer.writerow(row_dict)
+    save_manifest(output_dir, manifest)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -128,11 +301,22 @@ def main():
                         '"extract_values"')
     parser.add_argument('-r','--resource-dir', help='resource unit directory')
     parser.add_argument('-d','--output-dir', help='output directory')
+    parser.add_argument('-j','--jobs', type=int, default=1,
+                        help='number of regions to process at once, 0 for '
+                        'one per cpu')
+    parser.add_argument('-i','--incremental', action='store_true',
+                        help='skip regions whose source files have not '
+                        'changed since the last run, see %s'
+                        % MANIFEST_FILENAME)
+    parser.add_argument('-b','--bundle', action='store_true',
+                        help='with extract_values, also validate the '
+                        'tables and compile them into %s' % BUNDLE_FILENAME)
     args = parser.parse_args()
 
     action = args.action
     output_dir = args.output_dir or ''
     resource_dir = args.resource_dir or 'ResourceUnit'
+    jobs = args.jobs or multiprocessing.cpu_count()
 
     if action != 'extract_species' and action != 'extract_values':
         parser.print_help()
@@ -145,9 +329,10 @@ def main():
 
 
     if action == 'extract_species':
-        extract_species(output_dir, resource_dir)
+        extract_species(output_dir, resource_dir, jobs, args.incremental)
     elif action == 'extract_values':
-        extract_data(output_dir, resource_dir)
+        extract_data(output_dir, resource_dir, jobs, args.incremental,
+                     args.bundle)
 
 if __name__ == '__main__':
     main()
@@ -19,5 +19,9 @@ setup(
     url='https://github.com/azavea/eco.py',
     license=license,
     package_data={'eco': ['data/*']},
+    extras_require={
+        # eco.aio, on python 2
+        'async': ['trollius', 'futures'],
+    },
     packages=find_packages(exclude=('tests', 'docs'))
 )
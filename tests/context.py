@@ -5,4 +5,16 @@ sys.path.insert(0, os.path.join(
     '..'))
 
 from eco import benefits  # NOQA
-from eco.core import Benefits  # NOQA
+from eco.core import (Benefits, chunk_trees, interp_rows,  # NOQA
+                      interp_tensor, interp_grid, data_base, BenefitStats,
+                      make_conversion_table, apply_conversion_table)
+from eco.aggregate import BenefitAggregate  # NOQA
+from eco.bundle import (build_bundle, read_bundle, read_factor_csv,  # NOQA
+                        validate_factor_csv, list_data_files)
+
+import extractor  # NOQA
+
+try:
+    from eco.aio import AsyncBenefits, asyncio  # NOQA
+except ImportError:
+    AsyncBenefits = asyncio = None
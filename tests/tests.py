@@ -1,6 +1,21 @@
-from unittest import TestCase, main
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, main, skipIf
 
-from .context import benefits, Benefits
+import numpy as np
+
+from .context import (benefits, Benefits, BenefitAggregate, AsyncBenefits,
+                      asyncio, BenefitStats, interp_rows,
+                      interp_tensor, interp_grid, chunk_trees, data_base,
+                      build_bundle, read_bundle, read_factor_csv,
+                      validate_factor_csv, make_conversion_table,
+                      apply_conversion_table, list_data_files, extractor)
 
 
 class TestEco(TestCase):
@@ -15,8 +30,6 @@ class TestEco(TestCase):
 
     def test_factors(self):
         regions = benefits.regions
-        factors_set = {frozenset(benefits.factors_for_region(region))
-                       for region in regions}
 
         factors_we_use = set(['electricity',
                               'natural_gas',
@@ -34,10 +47,20 @@ class TestEco(TestCase):
                               'aq_voc_avoided',
                               'bvoc'])
 
-        self.assertEqual(len(factors_set), 1)
-        factors = factors_set.pop()
+        for region in regions:
+            factors = benefits.factors_for_region(region)
+
+            self.assertTrue(factors_we_use.issubset(factors))
+            for factor in factors:
+                self.assertTrue(os.path.exists(os.path.join(
+                    data_base, 'output__%s__%s.csv' % (region, factor))))
 
-        self.assertTrue(factors_we_use.issubset(factors))
+        # Some regions ship the extra building type tables and some don't
+        self.assertIn('electricity-sfr',
+                      benefits.factors_for_region('NoEastXXX'))
+        self.assertNotIn('electricity-sfr',
+                         benefits.factors_for_region('CaNCCoJBK'))
+        self.assertRaises(Exception, benefits.factors_for_region, 'Nowhere')
 
     def test_species_lookup(self):
         # Lookup a species that doesn't exist in any region
@@ -167,6 +190,975 @@ class TestEco(TestCase):
         self.assertEqual(int(aq['improvement'][0]*10), 63)
         self.assertEqual(int(aq['improvement'][1]*10), 127)
 
+    def test_get_factors_and_conversions_for_trees(self):
+        region = 'NoEastXXX'
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('ACPL', 60.0),
+                 ('ACSA1', 120.0)]
+
+        results = benefits.get_factors_and_conversions_for_trees(
+            region, Benefits.AIR_QUALITY_FACTORS, trees)
+
+        self.assertEqual(set(results), set(Benefits.AIR_QUALITY_FACTORS))
+
+        for factor in Benefits.AIR_QUALITY_FACTORS:
+            self.assertEqual(results[factor],
+                             benefits.get_factor_and_conversion_for_trees(
+                                 region, factor, trees))
+
+    def test_factor_tensor(self):
+        region = 'NoEastXXX'
+        tensor = benefits.get_factor_tensor(region)
+        breaks, data = benefits._get_data(region, 'bvoc')
+
+        self.assertEqual(tensor.factors, Benefits.BENEFIT_FACTORS)
+        self.assertEqual(tensor.values.shape,
+                         (len(tensor.factors), len(tensor.species_index),
+                          len(tensor.breaks)))
+        self.assertTrue(np.array_equal(
+            tensor.values[tensor.factor_index['bvoc'],
+                          tensor.species_index['ACPL']],
+            data['ACPL']))
+
+        dbhs = [0.0, 3.81, 10.0, 55.5, 114.3, 200.0]
+        self.assertTrue(np.allclose(
+            interp_rows(breaks, data['ACPL'], dbhs),
+            np.interp(dbhs, breaks, data['ACPL'])))
+
+    def test_compiled_benefits(self):
+        region = 'NoEastXXX'
+        compiled = Benefits(compiled=True)
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('ACPL', 60.0),
+                 ('ACSA1', 120.0), ('BDS OTHER', 1630.0)]
+
+        expected = benefits.get_air_quality_stats(region, trees)
+        actual = compiled.get_air_quality_stats(region, trees)
+        for key in expected:
+            self.assertAlmostEqual(expected[key][0], actual[key][0])
+
+        self.assertRaises(Exception, compiled.get_co2_stats,
+                          region, [('NOT A CODE', 10.0)])
+
+    def test_bundle(self):
+        region = 'NoEastXXX'
+        tmpdir = tempfile.mkdtemp()
+        bundle_path = os.path.join(tmpdir, 'factors.bundle')
+
+        try:
+            build_bundle(data_base, bundle_path)
+            bundle = read_bundle(bundle_path, data_dir=data_base)
+
+            mapped = Benefits(bundle_path=bundle_path, mmap=True)
+            trees = [('ACPL', 10.0), ('BDS OTHER', 1630.0)]
+            self.assertEqual(mapped.get_co2_stats(region, trees),
+                             benefits.get_co2_stats(region, trees))
+            self.assertIsInstance(mapped._get_bundle()._values, np.memmap)
+            del mapped
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertIn((region, 'bvoc'), bundle)
+        self.assertNotIn((region, 'not_a_factor'), bundle)
+
+        for factor in ['bvoc', 'co2_storage', 'hydro_interception']:
+            csv_breaks, csv_data = read_factor_csv(os.path.join(
+                data_base, 'output__%s__%s.csv' % (region, factor)))
+            breaks, data = bundle.get(region, factor)
+
+            self.assertTrue(np.array_equal(csv_breaks, breaks))
+            self.assertEqual(set(csv_data), set(data))
+            for code in csv_data:
+                self.assertTrue(np.array_equal(csv_data[code], data[code]))
+
+        bundled = Benefits()
+        bundled._loaded['bundle'] = bundle
+        self.assertEqual(bundled.get_co2_stats(region, trees),
+                         benefits.get_co2_stats(region, trees))
+
+    def test_lookup_species_codes(self):
+        region = 'NoEastXXX'
+        names = [('Cedrus', 'atlantica'),
+                 ('Ecoputius',),
+                 ('Magnolia', 'x soulangiana', None),
+                 ('cedrus', 'atlantica', None)]
+
+        codes = benefits.lookup_species_codes(region, names)
+
+        self.assertEqual(codes, [benefits.lookup_species_code(region, *name)
+                                 for name in names])
+        self.assertEqual(codes[1], None)
+        self.assertEqual(codes[2], 'BDS OTHER')
+        self.assertEqual(codes[0], codes[3])
+
+    def test_get_factors_for_tree_arrays(self):
+        region = 'NoEastXXX'
+        factors = ['bvoc', 'co2_storage', 'electricity']
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('ACPL', 60.0),
+                 ('ACSA1', 120.0), ('ACRU', 0.0)]
+        codes, dbhs = zip(*trees)
+
+        per_tree, totals = benefits.get_factors_for_tree_arrays(
+            region, factors, codes, dbhs)
+
+        self.assertEqual(per_tree.shape, (len(factors), len(trees)))
+
+        for i, factor in enumerate(factors):
+            self.assertAlmostEqual(
+                totals[factor][0],
+                benefits.get_factor_for_trees(region, factor, trees))
+
+            for j, tree in enumerate(trees):
+                self.assertAlmostEqual(
+                    per_tree[i, j],
+                    benefits.get_factor_for_trees(region, factor, [tree]))
+
+        structured = np.array(trees, dtype=[('species_code', 'S16'),
+                                            ('dbh', float)])
+        structured_per_tree, _ = benefits.get_factors_for_tree_arrays(
+            region, factors, structured)
+        self.assertTrue(np.array_equal(per_tree, structured_per_tree))
+
+        tensor = benefits.get_factor_tensor(region, factors)
+        self.assertTrue(np.array_equal(
+            interp_tensor(tensor, [tensor.species_index['ACPL']], [10.0]),
+            per_tree[:, :1]))
+
+        self.assertRaises(Exception, benefits.get_factors_for_tree_arrays,
+                          region, factors, ['NOT A CODE'], [10.0])
+
+    def test_per_tree_benefits(self):
+        region = 'NoEastXXX'
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('ACPL', 60.0),
+                 ('ACSA1', 120.0)]
+        conversions = Benefits({'co2_sequestered': 2, 'aq_ozone_dep': 3})
+
+        for b in [benefits, conversions]:
+            summaries = [b.get_co2_stats, b.get_air_quality_stats]
+            for summary in summaries:
+                per_tree = summary(region, trees, per_tree=True)
+
+                for i, tree in enumerate(trees):
+                    single = summary(region, [tree])
+
+                    for key in single:
+                        for value, values in zip(single[key], per_tree[key]):
+                            if value is None:
+                                self.assertIsNone(values)
+                            else:
+                                self.assertAlmostEqual(value, values[i])
+
+            for summary in [b.get_energy_conserved,
+                            b.get_stormwater_management]:
+                per_tree = summary(region, trees, per_tree=True)
+                self.assertEqual(len(per_tree[0]), len(trees))
+                self.assertAlmostEqual(np.sum(per_tree[0]),
+                                       summary(region, trees)[0])
+
+        bvoc, converted = benefits.get_factor_and_conversion_for_trees(
+            region, 'bvoc', trees, per_tree=True)
+        self.assertEqual(len(bvoc), len(trees))
+        self.assertIsNone(converted)
+
+    def test_benefit_aggregate(self):
+        region = 'NoEastXXX'
+        conversions = Benefits({'bvoc': 2})
+        aggregate = BenefitAggregate(conversions, ['bvoc', 'co2_storage'])
+
+        trees = {1: ('ACPL', 10.0), 2: ('ACRU', 25.5), 3: ('ACPL', 60.0)}
+        for tree_id, (code, dbh) in trees.iteritems():
+            aggregate.add(tree_id, region, code, dbh)
+
+        aggregate.add(4, 'CaNCCoJBK', 'BDS OTHER', 20.0)
+        self.assertRaises(Exception, aggregate.add, 1, region, 'ACPL', 5.0)
+        self.assertRaises(Exception, aggregate.add,
+                          5, region, 'NOT A CODE', 5.0)
+
+        aggregate.remove(2)
+        del trees[2]
+        aggregate.update_dbh(3, 80.0)
+        trees[3] = ('ACPL', 80.0)
+
+        self.assertEqual(len(aggregate), 3)
+        self.assertEqual(aggregate.regions, {region, 'CaNCCoJBK'})
+
+        totals = aggregate.totals(region)
+        expected = conversions.get_factors_and_conversions_for_trees(
+            region, aggregate.factors, trees.values())
+
+        for factor in aggregate.factors:
+            self.assertAlmostEqual(totals[factor][0], expected[factor][0])
+        self.assertAlmostEqual(totals['bvoc'][1], expected['bvoc'][1])
+        self.assertIsNone(totals['co2_storage'][1])
+
+        aggregate.remove(4)
+        self.assertEqual(aggregate.regions, {region})
+        self.assertEqual(aggregate.totals('CaNCCoJBK')['bvoc'], (0.0, 0.0))
+        self.assertRaises(Exception, aggregate.remove, 4)
+
+        # Trees are evaluated the same way as by the instance's own array
+        # methods
+        gridded = Benefits(interpolation='grid')
+        aggregate = BenefitAggregate(gridded, ['bvoc', 'co2_storage'])
+        trees = {1: ('ACPL', 10.04), 2: ('ACRU', 25.53)}
+        for tree_id, (code, dbh) in trees.iteritems():
+            aggregate.add(tree_id, region, code, dbh)
+
+        codes, dbhs = zip(*trees.values())
+        _, expected = gridded.get_factors_for_tree_arrays(
+            region, aggregate.factors, codes, dbhs)
+        totals = aggregate.totals(region)
+
+        for factor in aggregate.factors:
+            self.assertAlmostEqual(totals[factor][0], expected[factor][0])
+
+    def test_get_factors_by_group(self):
+        region = 'NoEastXXX'
+        factors = ['bvoc', 'hydro_interception']
+        trees = [('ACPL', 10.0, 'north'), ('ACRU', 25.5, 'south'),
+                 ('ACPL', 60.0, 'north'), ('ACSA1', 120.0, 'east')]
+        codes, dbhs, groups = zip(*trees)
+
+        by_group = Benefits({'bvoc': 2}).get_factors_by_group(
+            region, factors, codes, dbhs, groups)
+
+        self.assertEqual(set(by_group), {'north', 'south', 'east'})
+
+        for group in by_group:
+            expected = benefits.get_factors_and_conversions_for_trees(
+                region, factors,
+                [(code, dbh) for code, dbh, g in trees if g == group])
+
+            for factor in factors:
+                self.assertAlmostEqual(by_group[group][factor][0],
+                                       expected[factor][0])
+
+            self.assertAlmostEqual(by_group[group]['bvoc'][1],
+                                   2 * expected['bvoc'][0])
+            self.assertIsNone(by_group[group]['hydro_interception'][1])
+
+    def test_factors_for_chunks(self):
+        region = 'NoEastXXX'
+        factors = ['bvoc', 'co2_storage']
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('ACPL', 60.0),
+                 ('ACSA1', 120.0), ('ACRU', 3.0)]
+        conversions = Benefits({'bvoc': 2})
+
+        chunks = list(chunk_trees(iter(trees), 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+        per_chunk = list(conversions.iter_factors_for_chunks(
+            region, factors, iter(chunks)))
+        self.assertEqual(len(per_chunk), 3)
+        self.assertEqual(per_chunk[2],
+                         conversions.get_factors_and_conversions_for_trees(
+                             region, factors, trees[4:]))
+
+        totals = conversions.get_factors_for_chunks(
+            region, factors, chunk_trees(iter(trees), 2))
+        expected = conversions.get_factors_and_conversions_for_trees(
+            region, factors, trees)
+
+        for factor in factors:
+            self.assertAlmostEqual(totals[factor][0], expected[factor][0])
+        self.assertAlmostEqual(totals['bvoc'][1], expected['bvoc'][1])
+        self.assertIsNone(totals['co2_storage'][1])
+
+        # Chunks don't evict cached results
+        cached = Benefits(result_cache_size=1)
+        cached.get_co2_stats(region, trees)
+        cached.get_factors_for_chunks(region, factors,
+                                      chunk_trees(iter(trees), 2))
+        cached.get_co2_stats(region, trees)
+
+        self.assertEqual(cached.result_cache_info()['hits'], 1)
+        self.assertEqual(cached.result_cache_info()['size'], 1)
+
+    def test_factors_in_parallel(self):
+        region = 'NoEastXXX'
+        factors = ['bvoc', 'co2_storage']
+        codes = ['ACPL', 'ACRU', 'ACPL', 'ACSA1', 'ACRU'] * 20
+        dbhs = np.linspace(0.0, 150.0, len(codes))
+        conversions = Benefits({'bvoc': 2})
+
+        _, expected = conversions.get_factors_for_tree_arrays(
+            region, factors, codes, dbhs)
+
+        for workers in [1, 3]:
+            totals = conversions.get_factors_in_parallel(
+                region, factors, codes, dbhs, workers=workers)
+
+            for factor in factors:
+                self.assertAlmostEqual(totals[factor][0],
+                                       expected[factor][0])
+            self.assertAlmostEqual(totals['bvoc'][1], expected['bvoc'][1])
+            self.assertIsNone(totals['co2_storage'][1])
+
+            self.assertRaises(Exception, conversions.get_factors_in_parallel,
+                              region, factors, ['ACPL', 'ACPL', 'ACRU'],
+                              [10.0, 2.0], workers=workers)
+
+        # The workers' counters are merged into the caller's stats, and
+        # forked workers reuse the tables the caller has already loaded
+        counted = Benefits(stats=True)
+        counted.get_factors_in_parallel(region, factors, codes, dbhs,
+                                        workers=3)
+        counters = counted.get_stats()['counters']
+        self.assertEqual(counters['trees'], len(codes))
+        self.assertTrue(counters['table_loads'] > 0)
+
+        counted.preload([region])
+        counted.reset_stats()
+        counted.get_factors_in_parallel(region, factors, codes, dbhs,
+                                        workers=3)
+        counters = counted.get_stats()['counters']
+        self.assertEqual(counters['trees'], len(codes))
+        if sys.platform != 'win32':
+            self.assertNotIn('table_loads', counters)
+
+    def test_get_factors_by_region(self):
+        factors = ['bvoc', 'hydro_interception']
+        trees = [('NoEastXXX', 'ACPL', 10.0),
+                 ('CaNCCoJBK', 'BDS OTHER', 25.5),
+                 ('NoEastXXX', 'ACRU', 60.0),
+                 ('PacfNWLOG', 'BDS OTHER', 120.0),
+                 ('CaNCCoJBK', 'BDS OTHER', 4.0)]
+        regions, codes, dbhs = zip(*trees)
+
+        by_region, totals = Benefits({'bvoc': 2}).get_factors_by_region(
+            regions, factors, codes, dbhs)
+
+        self.assertEqual(set(by_region), set(regions))
+
+        for factor in factors:
+            region_sum = 0
+            for region in by_region:
+                expected = benefits.get_factor_for_trees(
+                    region, factor,
+                    [(code, dbh) for r, code, dbh in trees if r == region])
+                self.assertAlmostEqual(by_region[region][factor][0],
+                                       expected)
+                region_sum += expected
+
+            self.assertAlmostEqual(totals[factor][0], region_sum)
+
+        self.assertAlmostEqual(totals['bvoc'][1], 2 * totals['bvoc'][0])
+        self.assertIsNone(totals['hydro_interception'][1])
+
+    def test_grid_interpolation(self):
+        region = 'NoEastXXX'
+        factors = ['bvoc', 'co2_storage']
+        gridded = Benefits(interpolation='grid')
+
+        # Recorded to 0.1 cm the grid lookup matches exact interpolation
+        codes = ['ACPL', 'ACRU', 'ACPL', 'ACSA1', 'ACRU']
+        dbhs = [0.0, 25.5, 60.1, 120.0, 3.8]
+        exact, _ = benefits.get_factors_for_tree_arrays(
+            region, factors, codes, dbhs)
+        quantized, _ = gridded.get_factors_for_tree_arrays(
+            region, factors, codes, dbhs)
+        self.assertTrue(np.allclose(exact, quantized))
+
+        grid = gridded.get_factor_grid(region, factors)
+        self.assertEqual(grid.resolution, 0.1)
+        self.assertTrue(np.array_equal(
+            interp_grid(grid, [grid.species_index['ACRU']], [25.5]),
+            quantized[:, 1:2]))
+
+        # Between grid points the error is at most half a grid step of
+        # the steepest slope, a small fraction of the largest value
+        tensor = gridded.get_factor_tensor(region, factors)
+        errors = gridded.check_grid_accuracy(region, factors)
+        self.assertEqual(set(errors), set(factors))
+        for factor in factors:
+            largest = np.nanmax(
+                np.abs(tensor.values[tensor.factor_index[factor]]))
+            self.assertTrue(0 < errors[factor] < largest * 0.01)
+
+        # At grid points only the grid's float32 rounding is left
+        errors = gridded.check_grid_accuracy(region, factors,
+                                             dbhs=[0.0, 10.1, 55.5])
+        for factor in factors:
+            largest = np.nanmax(
+                np.abs(tensor.values[tensor.factor_index[factor]]))
+            self.assertTrue(errors[factor] <= largest * 1e-6)
+
+        # The grid only holds the benefit factors, others get their own
+        self.assertEqual(gridded.get_factor_grid(region).values.dtype,
+                         np.float32)
+        region_grid = gridded._grid_cache[(region, 0.1)]
+        self.assertEqual(set(region_grid.factors),
+                         set(Benefits.BENEFIT_FACTORS))
+        lsa = gridded.get_factor_grid(region, ['lsa'])
+        self.assertEqual(lsa.factors, ('lsa',))
+        self.assertNotIn('lsa', region_grid.factor_index)
+        quantized, _ = gridded.get_factors_for_tree_arrays(
+            region, ['lsa', 'bvoc'], codes, dbhs)
+        exact, _ = benefits.get_factors_for_tree_arrays(
+            region, ['lsa', 'bvoc'], codes, dbhs)
+        self.assertTrue(np.allclose(exact, quantized))
+        self.assertRaises(Exception, gridded.get_factor_grid, region,
+                          ['not_a_factor'])
+
+        self.assertRaises(Exception, Benefits, interpolation='cubic')
+
+    def test_scalar_interp(self):
+        breaks = [3.81, 11.43, 22.86]
+        values = [1.0, 2.0, 4.0]
+
+        self.assertAlmostEqual(benefits.interp(breaks, values, 1.905), 0.5)
+        self.assertEqual(benefits.interp(breaks, values, 3.81), 1.0)
+        self.assertAlmostEqual(benefits.interp(breaks, values, 17.145), 3.0)
+        self.assertEqual(benefits.interp(breaks, values, 22.86), 4.0)
+        self.assertEqual(benefits.interp(breaks, values, 50.0), 4.0)
+
+    def test_species_resolution(self):
+        region = 'CaNCCoJBK'
+        factors = ['bvoc', 'co2_storage']
+
+        resolution = benefits.get_species_resolution(region, factors)
+        self.assertEqual(set(resolution), set(factors))
+        self.assertEqual(resolution['bvoc']['PRCE'], 'PRCE')
+        self.assertEqual(resolution['bvoc']['ACPL'], 'BDL OTHER')
+        self.assertNotIn('NOT A CODE', resolution['bvoc'])
+
+        codes = ['ACPL', 'PRCE', 'NOT A CODE', 'ACPL']
+        dbhs = [10.0, 20.0, 30.0, 40.0]
+        conversions = Benefits({'bvoc': 2})
+
+        per_tree, totals, unresolved = conversions.get_factors_with_fallbacks(
+            region, factors, codes, dbhs)
+
+        self.assertEqual(unresolved.tolist(), [2])
+        self.assertTrue(np.isnan(per_tree[:, 2]).all())
+
+        expected_trees = [('BDL OTHER', 10.0), ('PRCE', 20.0),
+                          ('BDL OTHER', 40.0)]
+        expected = conversions.get_factors_and_conversions_for_trees(
+            region, factors, expected_trees)
+
+        for factor in factors:
+            self.assertAlmostEqual(totals[factor][0], expected[factor][0])
+        self.assertAlmostEqual(totals['bvoc'][1], expected['bvoc'][1])
+
+        self.assertRaises(Exception, benefits.get_factors_for_tree_arrays,
+                          region, factors, codes, dbhs)
+
+    def test_result_cache(self):
+        region = 'NoEastXXX'
+        cached = Benefits(result_cache_size=2)
+        trees = [('ACPL', 10.0), ('ACRU', 25.5)]
+        other_trees = [('ACPL', 10.0), ('ACRU', 25.6)]
+
+        expected = benefits.get_co2_stats(region, trees)
+        self.assertEqual(cached.get_co2_stats(region, trees), expected)
+        self.assertEqual(cached.get_co2_stats(region, iter(trees)), expected)
+        self.assertEqual(cached.result_cache_info(),
+                         {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2})
+
+        cached.get_co2_stats(region, other_trees)
+        cached.get_air_quality_stats(region, trees)
+        self.assertEqual(cached.result_cache_info()['size'], 2)
+        self.assertEqual(cached.result_cache_info()['misses'], 3)
+
+        # The first co2 result was the least recently used, so is evicted
+        cached.get_co2_stats(region, trees)
+        self.assertEqual(cached.result_cache_info()['misses'], 4)
+
+        cached.clear_result_cache()
+        self.assertEqual(cached.result_cache_info(),
+                         {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 2})
+
+        self.assertEqual(benefits.result_cache_info()['maxsize'], 0)
+
+    def test_concurrent_loading(self):
+        region = 'NoEastXXX'
+        shared = Benefits()
+        loads = []
+
+        original_get_bundle = shared._get_bundle
+
+        def counting_get_bundle():
+            loads.append(threading.current_thread())
+            time.sleep(0.01)
+            return original_get_bundle()
+
+        shared._get_bundle = counting_get_bundle
+
+        trees = [('ACPL', 10.0), ('BDS OTHER', 1630.0)]
+        results = []
+
+        def run():
+            results.append(shared.get_co2_stats(region, trees))
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each of the three co2 tables is only loaded once
+        self.assertEqual(len(loads), len(Benefits.CO2_FACTORS))
+        self.assertEqual(results, [benefits.get_co2_stats(region, trees)] * 8)
+
+    def test_preload(self):
+        region = 'NoEastXXX'
+        preloaded = Benefits(interpolation='grid')
+        preloaded.preload(regions=[region])
+
+        self.assertEqual(len(preloaded._factor_cache),
+                         len(preloaded.factors_for_region(region)))
+        self.assertEqual(len(preloaded._grid_cache), 1)
+
+        # Nothing is left to build on the first requests
+        trees = [('ACPL', 10.0), ('BDS OTHER', 1630.0)]
+        for instance in [preloaded, Benefits(compiled=True)]:
+            instance.preload(regions=[region])
+            loaded = (dict(instance._factor_cache),
+                      dict(instance._tensor_cache),
+                      dict(instance._grid_cache))
+
+            instance.get_co2_stats(region, trees)
+            instance.get_air_quality_stats(region, trees)
+            instance.get_energy_conserved(region, trees)
+            instance.get_stormwater_management(region, trees)
+            instance.get_factors_for_tree_arrays(region, None, ['ACPL'],
+                                                 [10.0])
+
+            self.assertEqual(loaded, (instance._factor_cache,
+                                      instance._tensor_cache,
+                                      instance._grid_cache))
+
+        preloaded = Benefits()
+        preloaded.preload(factors=['bvoc'])
+        self.assertEqual(len(preloaded._factor_cache),
+                         len(preloaded.regions))
+        self.assertEqual(len(preloaded._tensor_cache), 0)
+
+    @skipIf(asyncio is None, 'asyncio is not available')
+    def test_async_benefits(self):
+        trees = [('BDS OTHER', 10.0), ('BDS OTHER', 1630.0)]
+        regions = ['NoEastXXX', 'CaNCCoJBK', 'PacfNWLOG']
+
+        loop = asyncio.new_event_loop()
+        try:
+            async_benefits = AsyncBenefits(Benefits(), loop=loop)
+
+            results = loop.run_until_complete(asyncio.gather(
+                *[async_benefits.get_air_quality_stats(region, trees)
+                  for region in regions + regions]))
+        finally:
+            loop.close()
+
+        for region, result in zip(regions + regions, results):
+            self.assertEqual(result,
+                             benefits.get_air_quality_stats(region, trees))
+
+        # Each region's tables were loaded once, even though two requests
+        # for it ran at the same time
+        self.assertEqual(len(async_benefits.benefits._factor_cache),
+                         len(regions) * len(Benefits.AIR_QUALITY_FACTORS))
+
+    def test_stats(self):
+        trees = [('BDS OTHER', 10.0), ('BDS OTHER', 1630.0)]
+        region = 'NoEastXXX'
+
+        self.assertEqual(Benefits().get_stats(), {})
+
+        events = []
+        instrumented = Benefits(stats_callback=lambda *e: events.append(e))
+
+        result = instrumented.get_air_quality_stats(region, trees)
+        instrumented.get_air_quality_stats(region, trees)
+
+        self.assertEqual(result, benefits.get_air_quality_stats(region, trees))
+
+        stats = instrumented.get_stats()
+        counters = stats['counters']
+
+        self.assertEqual(counters['table_loads'],
+                         len(Benefits.AIR_QUALITY_FACTORS))
+        self.assertEqual(counters['trees'], 2 * len(trees))
+        # Each table is looked up once per call, missing the first time
+        self.assertEqual(counters['table_cache_misses'],
+                         len(Benefits.AIR_QUALITY_FACTORS))
+        self.assertEqual(counters['table_cache_hits'],
+                         len(Benefits.AIR_QUALITY_FACTORS))
+
+        self.assertEqual(set(stats['timings']), set(BenefitStats.PHASES))
+        self.assertTrue(all(seconds >= 0
+                            for seconds in stats['timings'].values()))
+
+        self.assertEqual(
+            sum(n for kind, name, n in events
+                if kind == 'count' and name == 'table_loads'),
+            counters['table_loads'])
+        self.assertTrue(('time', 'load') in
+                        {(kind, name) for kind, name, _ in events})
+
+        instrumented.reset_stats()
+        self.assertEqual(instrumented.get_stats()['counters'], {})
+
+    def test_validate_factor_csv(self):
+        region = 'InlEmpCLM'
+        factor = 'hydro_interception'
+        data_file = os.path.join(
+            data_base, 'output__%s__%s.csv' % (region, factor))
+
+        csv_breaks, csv_data = read_factor_csv(data_file)
+        breaks, data = validate_factor_csv(data_file)
+
+        # The worksheet note keyed by a dbh is dropped
+        self.assertIn('22.86', csv_data)
+        self.assertEqual(set(csv_data) - set(data), {'22.86'})
+        self.assertTrue(np.array_equal(csv_breaks, breaks))
+        for code in data:
+            self.assertTrue(np.array_equal(csv_data[code], data[code]))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            bundle_path = os.path.join(tmpdir, 'factors.bundle')
+            build_bundle(data_base, bundle_path, validate=True)
+
+            bundle = read_bundle(bundle_path, data_dir=data_base)
+            self.assertIn((region, factor), bundle)
+            self.assertNotIn((region, 'species_codes'), bundle)
+
+            bad_file = os.path.join(tmpdir, 'output__Bad__bvoc.csv')
+            for contents in [',1,2,3\nACPL,1,2\n',
+                             ',1,3,2\nACPL,1,2,3\n',
+                             ',1,2,3\nACPL,1,x,3\n']:
+                open(bad_file, 'w').write(contents)
+                self.assertRaises(Exception, validate_factor_csv, bad_file)
+                self.assertRaises(Exception, build_bundle, tmpdir,
+                                  bundle_path, validate=True)
+
+            # A failed build leaves the previous bundle in place
+            self.assertIn((region, factor),
+                          read_bundle(bundle_path, data_dir=data_base))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lazy_import(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ('import sys, eco; '
+                  'assert "numpy" not in sys.modules; '
+                  'assert "eco.core" not in sys.modules; '
+                  'from eco import benefits, Benefits; '
+                  'assert isinstance(benefits, Benefits)')
+
+        self.assertEqual(subprocess.call([sys.executable, '-c', script],
+                                         cwd=root), 0)
+
+    def test_data_dir(self):
+        region = 'NoEastXXX'
+        trees = [('ACPL', 10.0), ('BDS OTHER', 1630.0)]
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            for filename in os.listdir(data_base):
+                if region in filename or filename.startswith('species_'):
+                    shutil.copy(os.path.join(data_base, filename), tmpdir)
+
+            moved = Benefits(data_dir=tmpdir)
+
+            self.assertEqual(moved.regions, {region})
+            self.assertEqual(moved.get_co2_stats(region, trees),
+                             benefits.get_co2_stats(region, trees))
+            self.assertEqual(moved.lookup_species_code(region, 'Acer',
+                                                       'platanoides'),
+                             'ACPL')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_conversion_table(self):
+        regions = ['NoEastXXX', 'CaNCCoJBK', 'NoEastXXX', 'PacfNWLOG']
+        codes = ['ACPL', 'BDS OTHER', 'BDS OTHER', 'BDS OTHER']
+        dbhs = [10.0, 20.0, 30.0, 40.0]
+        factors = ['bvoc', 'hydro_interception', 'co2_storage']
+
+        totals = benefits.get_factor_totals(regions, factors, codes, dbhs)
+        self.assertEqual(totals.regions,
+                         ('CaNCCoJBK', 'NoEastXXX', 'PacfNWLOG'))
+        self.assertEqual(totals.values.shape, (3, 3))
+
+        scenarios = [
+            ('2015', {None: {'bvoc': 2.0, 'hydro_interception': 0.5}}),
+            ('2020', {None: {'bvoc': 3.0},
+                      'NoEastXXX': {'bvoc': 4.0, 'co2_storage': 0.1}}),
+        ]
+        # PacfNWLOG is priced under no scenario
+        table = make_conversion_table(scenarios, totals.regions[:2],
+                                      factors)
+
+        self.assertEqual(table.scenarios, ('2015', '2020'))
+        self.assertEqual(table.rates.shape, (2, 2, 3))
+
+        converted = apply_conversion_table(table, totals)
+        self.assertEqual(converted.shape, (2, 3))
+
+        for s, (_, conversions) in enumerate(scenarios):
+            for r, region in enumerate(totals.regions[:2]):
+                rates = dict(conversions[None])
+                rates.update(conversions.get(region, {}))
+
+                by_region, _ = Benefits(rates).get_factors_by_region(
+                    regions, factors, codes, dbhs)
+                expected = sum(converted_total for _, converted_total
+                               in by_region[region].values()
+                               if converted_total is not None)
+
+                self.assertAlmostEqual(converted[s, r], expected)
+
+            self.assertEqual(converted[s, 2], 0.0)
+
+    def test_project_factors(self):
+        region = 'NoEastXXX'
+        codes = ['ACPL', 'ACPL', 'ACRU', 'BDS OTHER']
+        dbhs = [6.1, 500.0, 1.0, 30.0]
+        factors = ['bvoc', 'co2_storage', 'hydro_interception']
+
+        ages, curves = benefits.get_growth_curves(region)
+        self.assertEqual(ages[0], 0.0)
+        self.assertTrue(all((np.diff(curve) >= 0).all()
+                            for curve in curves.values()))
+
+        projected = benefits.project_dbhs(region, codes, dbhs, [10, 20])
+        self.assertEqual(projected.shape, (2, len(dbhs)))
+
+        # ACPL is 6.1cm at 10 years, 13.9cm at 20 and 23.5cm at 30
+        self.assertAlmostEqual(projected[0, 0], 13.9)
+        self.assertAlmostEqual(projected[1, 0], 23.5)
+        # A tree past the end of its curve doesn't grow, or shrink
+        self.assertEqual(list(projected[:, 1]), [500.0, 500.0])
+        self.assertTrue((projected[1] >= projected[0]).all())
+
+        converted = Benefits({'bvoc': 2})
+        per_year, cumulative = converted.project_factors(region, factors,
+                                                         codes, dbhs, 5)
+
+        expected = np.zeros((len(factors), 5))
+        for year, year_dbhs in enumerate(
+                benefits.project_dbhs(region, codes, dbhs, 5)):
+            _, totals = benefits.get_factors_for_tree_arrays(
+                region, factors, codes, year_dbhs)
+            expected[:, year] = [totals[factor][0] for factor in factors]
+
+        for i, factor in enumerate(factors):
+            self.assertTrue(np.allclose(per_year[factor][0], expected[i]))
+            self.assertTrue(np.allclose(cumulative[factor][0],
+                                        np.cumsum(expected[i])))
+
+        self.assertTrue(np.allclose(per_year['bvoc'][1],
+                                    2 * per_year['bvoc'][0]))
+        self.assertIsNone(per_year['co2_storage'][1])
+
+        self.assertRaises(Exception, benefits.project_dbhs, region,
+                          ['NOT A SPECIES'], [10.0], 5)
+
+    def test_region_tensor(self):
+        region = 'NoEastXXX'
+        trees = [('ACPL', 10.0), ('ACRU', 25.5), ('BDS OTHER', 1630.0)]
+
+        for instance in [Benefits(compiled=True),
+                         Benefits(interpolation='grid')]:
+            instance.get_co2_stats(region, trees)
+            instance.get_air_quality_stats(region, trees)
+            instance.get_factors_for_tree_arrays(
+                region, ['bvoc', 'co2_storage'], ['ACPL'], [10.0])
+            instance.get_factors_for_tree_arrays(
+                region, ['co2_storage', 'bvoc'], ['ACPL'], [10.0])
+
+            # Every factor list is selected from one tensor per region
+            self.assertEqual(list(instance._tensor_cache), [region])
+            if instance._interpolation == 'grid':
+                self.assertEqual(len(instance._grid_cache), 1)
+
+        tensor = benefits.get_factor_tensor(region, ['co2_storage', 'bvoc'])
+        full = benefits.get_factor_tensor(region)
+
+        self.assertEqual(tensor.factors, ('co2_storage', 'bvoc'))
+        self.assertTrue(np.array_equal(
+            tensor.values[tensor.factor_index['bvoc']],
+            full.values[full.factor_index['bvoc']]))
+
+        self.assertRaises(Exception, benefits.get_factor_tensor, region,
+                          ['not_a_factor'])
+
+    def test_stale_bundle(self):
+        region = 'NoEastXXX'
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            for filename in os.listdir(data_base):
+                if region in filename or filename.startswith('species_'):
+                    shutil.copy(os.path.join(data_base, filename), tmpdir)
+
+            bundle_path = os.path.join(tmpdir, 'factors.bundle')
+            build_bundle(tmpdir, bundle_path)
+            self.assertIsNotNone(read_bundle(bundle_path))
+
+            data_file = os.path.join(tmpdir,
+                                     'output__%s__bvoc.csv' % region)
+            rows = open(data_file).read().split('\n')
+            for i, row in enumerate(rows):
+                if row.startswith('ACPL,'):
+                    rows[i] = 'ACPL,' + ','.join(['100'] * 9)
+            open(data_file, 'w').write('\n'.join(rows))
+
+            self.assertIsNone(read_bundle(bundle_path))
+
+            _, data = Benefits(data_dir=tmpdir)._get_data(region, 'bvoc')
+            self.assertEqual(list(data['ACPL']), [100.0] * 9)
+
+            # Removing a source file makes the bundle stale too
+            build_bundle(tmpdir, bundle_path)
+            os.remove(os.path.join(tmpdir, 'output__%s__lsa.csv' % region))
+            self.assertIsNone(read_bundle(bundle_path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_incremental_extraction(self):
+        tmpdir = tempfile.mkdtemp()
+        resource_dir = os.path.join(tmpdir, 'ResourceUnit')
+        output_dir = os.path.join(tmpdir, 'output')
+        os.mkdir(output_dir)
+
+        for region in ['RegionA', 'RegionB']:
+            os.makedirs(os.path.join(resource_dir, region))
+            open(os.path.join(resource_dir, region, 'ResourceUnit.html'),
+                 'w').write(region)
+
+        extracted = []
+
+        def extract_region_data(args):
+            data_dir, region, html_path = args
+            filename = 'output__%s__bvoc.csv' % region
+            with extractor.atomic_write(os.path.join(data_dir,
+                                                     filename)) as out:
+                out.write(',1,2\nACPL,1.0,%s\n' % len(open(html_path).read()))
+
+            extracted.append(region)
+            return [filename]
+
+        real_extract_region_data = extractor.extract_region_data
+        extractor.extract_region_data = extract_region_data
+        try:
+            self.assertEqual(
+                [region for region, _ in
+                 extractor.find_regions(resource_dir, 'ResourceUnit.html')],
+                ['RegionA', 'RegionB'])
+
+            extractor.extract_data(output_dir, resource_dir,
+                                   incremental=True)
+            self.assertEqual(extracted, ['RegionA', 'RegionB'])
+
+            open(os.path.join(resource_dir, 'RegionB', 'ResourceUnit.html'),
+                 'w').write('RegionB, updated')
+            extractor.extract_data(output_dir, resource_dir,
+                                   incremental=True)
+            self.assertEqual(extracted, ['RegionA', 'RegionB', 'RegionB'])
+
+            manifest = extractor.load_manifest(output_dir)['extract_values']
+            self.assertEqual(manifest['RegionB']['outputs'],
+                             ['output__RegionB__bvoc.csv'])
+
+            # Without the manifest's outputs a region is extracted again
+            os.remove(os.path.join(output_dir, 'output__RegionA__bvoc.csv'))
+            extractor.extract_data(output_dir, resource_dir,
+                                   incremental=True)
+            self.assertEqual(extracted[-1], 'RegionA')
+        finally:
+            extractor.extract_region_data = real_extract_region_data
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(extractor.run_regions(len, ['a', 'bb', 'ccc'], 2),
+                         [1, 2, 3])
+
+    def test_atomic_write(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'output.csv')
+
+        try:
+            with extractor.atomic_write(path) as out:
+                out.write('first')
+
+            def fail():
+                with extractor.atomic_write(path) as out:
+                    out.write('partial')
+                    raise IOError('disk full')
+
+            self.assertRaises(IOError, fail)
+
+            # The failed write left the earlier file and no temporary file
+            self.assertEqual(os.listdir(tmpdir), ['output.csv'])
+            self.assertEqual(open(path).read(), 'first')
+            self.assertEqual(extractor.hash_file(path),
+                             hashlib.sha1('first').hexdigest())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_leftover_temp_files_ignored(self):
+        region = 'NoEastXXX'
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            for filename in os.listdir(data_base):
+                if region in filename or filename.startswith('species_'):
+                    shutil.copy(os.path.join(data_base, filename), tmpdir)
+
+            # Files a killed extraction could leave behind, in both the
+            # current and the old temporary naming scheme
+            stray = ['.output__%s__bvoc.csv.4242.tmp' % region,
+                     'output__%s__bvoc.csv.tmp.4242' % region]
+            for filename in stray:
+                with open(os.path.join(tmpdir, filename), 'w') as out:
+                    out.write('dbh,1,2\nACPL,999,999\n')
+
+            data_file = os.path.join(tmpdir, 'output__%s__bvoc.csv' % region)
+            with extractor.atomic_write(data_file) as out:
+                stray.append(os.path.basename(out.name))
+                out.write(open(os.path.join(data_base, os.path.basename(
+                    data_file))).read())
+
+            listed = [f for _, _, f in list_data_files(tmpdir)]
+            for filename in stray:
+                self.assertNotIn(filename, listed)
+
+            bundle_path = os.path.join(tmpdir, 'factors.bundle')
+            build_bundle(tmpdir, bundle_path, validate=True)
+            trees = [('ACPL', 1.5)]
+            expected = benefits.get_factor_for_trees(region, 'bvoc', trees)
+            for instance in (Benefits(data_dir=tmpdir),
+                             Benefits(data_dir=tmpdir,
+                                      bundle_path=bundle_path)):
+                self.assertEqual(
+                    instance.get_factor_for_trees(region, 'bvoc', trees),
+                    expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_per_tree_matches_totals_with_grid(self):
+        region = 'NoEastXXX'
+        gridded = Benefits(interpolation='grid')
+
+        # Between grid points, where grid lookups differ from the totals
+        trees = [('ACPL', 10.04), ('ACRU', 25.53), ('ACSA1', 60.17)]
+        totals = gridded.get_co2_stats(region, trees)
+        per_tree = gridded.get_co2_stats(region, trees, per_tree=True)
+
+        for factor, (values, _) in per_tree.iteritems():
+            self.assertAlmostEqual(np.sum(values), totals[factor][0])
+
+        exact = benefits.get_co2_stats(region, trees, per_tree=True)
+        self.assertTrue(np.array_equal(per_tree['stored'][0],
+                                       exact['stored'][0]))
+
+        codes, dbhs = zip(*trees)
+        quantized, _ = gridded.get_factors_for_tree_arrays(
+            region, ['co2_storage'], codes, dbhs)
+        exact, _ = benefits.get_factors_for_tree_arrays(
+            region, ['co2_storage'], codes, dbhs)
+        self.assertFalse(np.allclose(quantized, exact, rtol=0, atol=1e-9))
+
 
 if __name__ == '__main__':
     main()